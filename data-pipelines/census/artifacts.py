@@ -0,0 +1,99 @@
+import json
+import os
+import shutil
+import tempfile
+from typing import Callable
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from loguru import logger
+
+ARTIFACT_DIR = os.getenv("ARTIFACT_DIR",
+                         os.path.join(os.path.dirname(os.path.abspath(__file__)), "artifacts"))
+
+# The link readers open artifacts through, pointing at the latest complete version
+CURRENT_LINK = "current"
+
+# Decimal places of longitude and latitude kept in the GeoJSON, about a meter,
+# as the app's `GEOJSON_PRECISION`
+GEOJSON_PRECISION = 5
+
+
+def write_geoparquet(data: gpd.GeoDataFrame, path: str, row_group_size: int = 1000):
+    """Writes `data` as GeoParquet. Small row groups let readers filtering on a
+    sorted column skip most of the file.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data.to_parquet(path, index=False, row_group_size=row_group_size)
+
+
+def write_geojson(data: gpd.GeoDataFrame, path: str, precision: int = GEOJSON_PRECISION):
+    """Writes `data` as compact GeoJSON, ready to be embedded in a map without
+    touching its geometries. Coordinates are rounded to `precision` decimal
+    places, dropping the vertices that become duplicate or collinear, and
+    features have no ids, bounding boxes or whitespace.
+    """
+    geometries = shapely.transform(np.asarray(data.geometry.array),
+                                   lambda coordinates: np.round(coordinates, precision))
+    # With no tolerance only points lying on the line between their neighbors are removed
+    geometries = shapely.simplify(geometries, 0)
+    data = gpd.GeoDataFrame(data.drop(columns=data.geometry.name),
+                            geometry=geometries, crs=data.crs)
+    data = data[~data.geometry.is_empty]
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({
+            "type": "FeatureCollection",
+            "features": list(data.iterfeatures(na="null", show_bbox=False, drop_id=True)),
+        }, f, separators=(",", ":"))
+
+
+def get_published_version() -> str:
+    link = os.path.join(ARTIFACT_DIR, CURRENT_LINK)
+    return os.readlink(link) if os.path.islink(link) else None
+
+
+def publish_artifacts(version: str, write: Callable) -> bool:
+    """Writes a version of the artifacts into its own directory and then
+    repoints `current` at it, so readers never see a partly written set. The
+    previous version is kept until the next publish, so readers that resolved
+    a path through `current` just before the swap can still open it.
+
+    Args:
+        version (str): The version of the artifacts, e.g. the hash of their source
+        write (Callable): Called as `write(directory)`; must write every artifact under it
+
+    Returns:
+        bool: True if the artifacts were written, False if `version` was already published
+    """
+    previous_version = get_published_version()
+    if previous_version == version:
+        logger.info(f"Artifacts {version} are already published, skipping")
+        return False
+
+    os.makedirs(ARTIFACT_DIR, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(dir=ARTIFACT_DIR, prefix=".staging-")
+    try:
+        write(staging_dir)
+        version_dir = os.path.join(ARTIFACT_DIR, version)
+        shutil.rmtree(version_dir, ignore_errors=True)
+        os.rename(staging_dir, version_dir)
+    except Exception:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+
+    # Replacing a link is atomic, unlike removing and recreating it
+    link = os.path.join(ARTIFACT_DIR, CURRENT_LINK)
+    staging_link = os.path.join(ARTIFACT_DIR, f".{CURRENT_LINK}-{version}")
+    os.symlink(version, staging_link)
+    os.replace(staging_link, link)
+    logger.success(f"Published artifacts {version}")
+
+    # Keep the previous version for one more publish, as readers may have resolved
+    # its paths just before the swap without having opened them yet
+    for name in os.listdir(ARTIFACT_DIR):
+        if name not in (version, previous_version, CURRENT_LINK) and not name.startswith("."):
+            shutil.rmtree(os.path.join(ARTIFACT_DIR, name), ignore_errors=True)
+    return True
@@ -0,0 +1,195 @@
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime, timezone
+
+import requests
+from loguru import logger
+
+CACHE_DIR = os.getenv("PIPELINE_CACHE_DIR",
+                      os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"))
+
+# Query parameters that are credentials rather than part of what is being requested
+UNCACHED_PARAMS = ["key"]
+
+
+class CacheMissError(Exception):
+    """Raised in offline mode when a request has never been cached"""
+
+
+def is_offline() -> bool:
+    """Offline mode is read from the environment so it also reaches pipeline stages running in worker processes
+    """
+    return os.getenv("PIPELINE_OFFLINE", "0") == "1"
+
+
+def get_cache_key(url: str, params: dict = None) -> str:
+    """Builds the cache key of a request from its URL and its parameters
+
+    Args:
+        url (str): The requested URL
+        params (dict, optional): Query parameters sent with the request. Defaults to None.
+
+    Returns:
+        str: A SHA-256 hex digest identifying the request
+    """
+    params = {k: v for k, v in (params or {}).items()
+              if k not in UNCACHED_PARAMS}
+    request = json.dumps({"url": url, "params": params}, sort_keys=True)
+    return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+
+def get_object_path(content_hash: str) -> str:
+    return os.path.join(CACHE_DIR, "objects", content_hash[:2], content_hash)
+
+
+def read_index(cache_key: str) -> dict:
+    path = os.path.join(CACHE_DIR, "index", f"{cache_key}.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_index(cache_key: str, entry: dict):
+    path = os.path.join(CACHE_DIR, "index", f"{cache_key}.json")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write then rename so stages running concurrently never read a partial entry
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path), delete=False) as f:
+        json.dump(entry, f)
+    os.replace(f.name, path)
+
+
+def get_revalidation_headers(entry: dict) -> dict:
+    headers = {}
+    if entry is not None and os.path.exists(get_object_path(entry["sha256"])):
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+def store_response(cache_key: str, url: str, params: dict, response: requests.Response, content_hash: str):
+    write_index(cache_key, {
+        "url": url,
+        "params": {k: v for k, v in (params or {}).items() if k not in UNCACHED_PARAMS},
+        "sha256": content_hash,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "fetched_at": datetime.now(timezone.utc).isoformat(),
+    })
+
+
+def build_response(url: str, content: bytes, content_hash: str) -> requests.Response:
+    """Wraps a cached body in a `requests.Response` so callers don't need to know where it came from
+    """
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.encoding = "utf-8"
+    response._content = content
+    response.content_hash = content_hash
+    return response
+
+
+def cached_get(url: str, params: dict = None, headers: dict = None, timeout: float = 300) -> requests.Response:
+    """A `requests.get` that stores every successful response gzip-compressed on
+    disk, addressed by the SHA-256 of its content. Cached responses are
+    revalidated with ETag / Last-Modified, and in offline mode they are replayed
+    without touching the network.
+
+    Args:
+        url (str): The URL to request
+        params (dict, optional): Query parameters. Defaults to None.
+        headers (dict, optional): Request headers. They are not part of the cache key. Defaults to None.
+        timeout (float, optional): Seconds to wait for the server. Defaults to 300.
+
+    Raises:
+        CacheMissError: In offline mode, if the request has never been cached
+
+    Returns:
+        requests.Response: The response, with a `content_hash` attribute for successful responses
+    """
+    cache_key = get_cache_key(url, params)
+    entry = read_index(cache_key)
+
+    if is_offline():
+        if entry is None:
+            raise CacheMissError(f"{url} is not in the cache")
+        logger.info(f"Replaying {url} from cache")
+        with gzip.open(get_object_path(entry["sha256"]), "rb") as f:
+            return build_response(url, f.read(), entry["sha256"])
+
+    request_headers = {**(headers or {}), **get_revalidation_headers(entry)}
+    response = requests.get(url, params=params,
+                            headers=request_headers, timeout=timeout)
+
+    if response.status_code == 304:
+        logger.info(f"{url} has not changed, reading it from cache")
+        with gzip.open(get_object_path(entry["sha256"]), "rb") as f:
+            return build_response(url, f.read(), entry["sha256"])
+
+    if response.status_code == 200:
+        content_hash = hashlib.sha256(response.content).hexdigest()
+        path = get_object_path(content_hash)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+                with gzip.GzipFile(fileobj=f, mode="wb") as gz:
+                    gz.write(response.content)
+            os.replace(f.name, path)
+        store_response(cache_key, url, params, response, content_hash)
+        response.content_hash = content_hash
+
+    return response
+
+
+def cached_download(url: str, chunk_size: int = 1024 * 1024) -> str:
+    """Streams `url` into the cache and returns the path of the cached file. The
+    file is stored as downloaded, since the files fetched this way (zipped
+    shapefiles) are already compressed. It is revalidated and replayed offline
+    in the same way as `cached_get`.
+
+    Args:
+        url (str): The file to download
+        chunk_size (int, optional): Bytes read from the socket at a time. Defaults to 1 MiB.
+
+    Raises:
+        CacheMissError: In offline mode, if the file has never been downloaded
+
+    Returns:
+        str: Path of the cached file, named by the SHA-256 of its content
+    """
+    cache_key = get_cache_key(url)
+    entry = read_index(cache_key)
+
+    if is_offline():
+        if entry is None:
+            raise CacheMissError(f"{url} is not in the cache")
+        logger.info(f"Replaying {url} from cache")
+        return get_object_path(entry["sha256"])
+
+    with requests.get(url, headers=get_revalidation_headers(entry), stream=True, timeout=300) as r:
+        if r.status_code == 304:
+            logger.info(f"{url} has not changed, reading it from cache")
+            return get_object_path(entry["sha256"])
+        r.raise_for_status()
+
+        # Hash while streaming to disk so the body is never held in memory
+        os.makedirs(os.path.join(CACHE_DIR, "objects"), exist_ok=True)
+        sha256 = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=os.path.join(CACHE_DIR, "objects"), delete=False) as f:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                sha256.update(chunk)
+                f.write(chunk)
+
+    content_hash = sha256.hexdigest()
+    path = get_object_path(content_hash)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    shutil.move(f.name, path)
+    store_response(cache_key, url, None, r, content_hash)
+    return path
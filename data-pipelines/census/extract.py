@@ -1,37 +1,227 @@
+import json
 import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterable, Iterator
 
+import fiona
 import geopandas as gpd
 import pandas as pd
 import requests
 from loguru import logger
 
+from cache import cached_download, cached_get
 
-def extract_2021_acs_5_year_data(geography="zcta") -> requests.Response:
-    if geography == "zcta":
-        geo_url_encoded = "zip%20code%20tabulation%20area:*"
-    elif geography == "cbsa":
-        geo_url_encoded = "metropolitan%20statistical%20area/micropolitan%20statistical%20area:*"
-    url = f"https://api.census.gov/data/2021/acs/acs5/profile?get=group(DP04)&for={geo_url_encoded}"
-    r = requests.get(url)
-    return r
+
+def get_acs_5_year_url(year=2021) -> str:
+    return f"https://api.census.gov/data/{year}/acs/acs5/profile"
+
+# The `for` predicate of each geography in the Census API
+GEOGRAPHY_PREDICATES = {
+    "zcta": "zip code tabulation area",
+    "cbsa": "metropolitan statistical area/micropolitan statistical area",
+}
+
+# The Census API returns at most 50 variables per request, NAME included
+MAX_VARIABLES_PER_REQUEST = 48
+
+# Responses worth retrying, anything else is a problem with the request itself
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+
+class RateLimiter:
+    """Spaces out requests made from any number of threads to at most `rate` per second"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_request = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_request - now
+            self.next_request = max(now, self.next_request) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def get_with_retries(url: str, params: dict, rate_limiter: RateLimiter, retries: int = 5, backoff: float = 1.0, timeout: float = 60) -> requests.Response:
+    """A `cached_get` that retries connection errors, timeouts and transient
+    status codes with exponential backoff and jitter.
+
+    Args:
+        url (str): The URL to request
+        params (dict): Query parameters
+        rate_limiter (RateLimiter): Shared by every request to the same API
+        retries (int, optional): Attempts after the first one. Defaults to 5.
+        backoff (float, optional): Seconds to wait before the first retry, doubled on every retry. Defaults to 1.0.
+        timeout (float, optional): Seconds to wait for the server. Defaults to 60.
+
+    Raises:
+        requests.RequestException: If the last attempt fails
+
+    Returns:
+        requests.Response: The successful response
+    """
+    for attempt in range(retries + 1):
+        rate_limiter.wait()
+        try:
+            r = cached_get(url, params=params, timeout=timeout)
+            if r.status_code not in RETRY_STATUS_CODES:
+                r.raise_for_status()
+                return r
+            error = requests.HTTPError(
+                f"{r.status_code} from {url}", response=r)
+            retry_after = r.headers.get("Retry-After")
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+            retry_after = None
+
+        if attempt == retries:
+            raise error
+        delay = float(retry_after) if retry_after and retry_after.isdigit() \
+            else backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+        logger.warning(
+            f"Request to {url} failed ({error}), retrying in {delay:.1f}s")
+        time.sleep(delay)
+
+
+def get_census_params(variables: list, geography: str, geography_ids: list = None) -> dict:
+    params = {
+        "get": ",".join(["NAME"] + variables),
+        "for": f"{GEOGRAPHY_PREDICATES[geography]}:{','.join(geography_ids) if geography_ids else '*'}",
+    }
+    # An API key raises the daily request limit, but isn't needed
+    key = os.getenv("CENSUS_API_KEY")
+    if key:
+        params["key"] = key
+    return params
 
 
-def extract_geography_boundaries(geography="zcta") -> gpd.GeoDataFrame:
+def list_geography_ids(geography: str, rate_limiter: RateLimiter, url: str) -> list:
+    """Lists the ids of every `geography` in the dataset, with a request that
+    only asks for their names, so the data can be requested in chunks of ids.
+    """
+    r = get_with_retries(url, get_census_params([], geography), rate_limiter)
+    rows = json.loads(r.text)
+    index = rows[0].index(GEOGRAPHY_PREDICATES[geography])
+    return sorted(row[index] for row in rows[1:])
+
+
+def extract_acs_5_year_data(variables: list, geography="zcta", year=2021,
+                            geographies_per_request: int = 500, max_workers: int = None,
+                            requests_per_second: float = None) -> list:
+    """Reads `variables` for every `geography` from the ACS 5-year data profiles of `year`. The
+    request is split into chunks of at most `MAX_VARIABLES_PER_REQUEST`
+    variables and `geographies_per_request` geographies, which are fetched
+    concurrently, rate limited and retried on their own, and merged by
+    geography id as they arrive.
+
+    Args:
+        variables (list): The variable codes to read
+        geography (str, optional): "zcta" or "cbsa". Defaults to "zcta".
+        year (int, optional): The ACS 5-year vintage, by its final year. Defaults to 2021.
+        geographies_per_request (int, optional): Geography ids per request. Defaults to 500.
+        max_workers (int, optional): Requests in flight at once. Defaults to `CENSUS_API_WORKERS`, or 8.
+        requests_per_second (float, optional): Request rate. Defaults to `CENSUS_API_RATE`, or 10.
+
+    Returns:
+        list: Rows in the format of the Census API, a header row followed by one row per geography
+    """
+    url = get_acs_5_year_url(year)
+    max_workers = max_workers or int(os.getenv("CENSUS_API_WORKERS", 8))
+    rate_limiter = RateLimiter(
+        requests_per_second or float(os.getenv("CENSUS_API_RATE", 10)))
+
+    geography_ids = list_geography_ids(geography, rate_limiter, url)
+    variable_chunks = list(batched(variables, MAX_VARIABLES_PER_REQUEST))
+    geography_chunks = list(batched(geography_ids, geographies_per_request))
+    logger.info(
+        f"Requesting {len(variables)} variables for {len(geography_ids)} geographies in {len(variable_chunks) * len(geography_chunks)} chunks")
+
+    predicate = GEOGRAPHY_PREDICATES[geography]
+    names = {}
+    values = {variable: {} for variable in variables}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(get_with_retries, url, get_census_params(variable_chunk, geography, geography_chunk), rate_limiter)
+                   for variable_chunk in variable_chunks for geography_chunk in geography_chunks]
+        for future in as_completed(futures):
+            rows = json.loads(future.result().text)
+            header = rows[0]
+            id_index = header.index(predicate)
+            name_index = header.index("NAME")
+            indexes = [(variable, header.index(variable))
+                       for variable in header if variable in values]
+            for row in rows[1:]:
+                names[row[id_index]] = row[name_index]
+                for variable, index in indexes:
+                    values[variable][row[id_index]] = row[index]
+
+    header = ["NAME"] + variables + [predicate]
+    return [header] + [[names[geography_id]] + [values[variable].get(geography_id) for variable in variables] + [geography_id]
+                       for geography_id in geography_ids if geography_id in names]
+
+
+def get_geography_boundaries_url(geography="zcta") -> str:
     if geography == "zcta":
         url = "https://www2.census.gov/geo/tiger/TIGER2021/ZCTA520/tl_2021_us_zcta520.zip"
     elif geography == "cbsa":
         url = "https://www2.census.gov/geo/tiger/TIGER2021/CBSA/tl_2021_us_cbsa.zip"
-    geo_data = gpd.read_file(url)
-    return geo_data
+    return url
+
+
+def download_geography_boundaries(geography="zcta") -> str:
+    """Downloads the zipped TIGER shapefile for `geography` into the cache
+
+    Returns:
+        str: Path of the cached zip, named by the SHA-256 of its content
+    """
+    return cached_download(get_geography_boundaries_url(geography))
+
+
+def batched(records: Iterable, batch_size: int) -> Iterator[list]:
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_geography_boundaries(path: str, batch_size: int = 2000) -> Iterator[gpd.GeoDataFrame]:
+    """Reads a zipped TIGER boundary shapefile in batches of `batch_size`
+    records, so only one batch of geometries is in memory at a time.
+
+    Args:
+        path (str): The zipped shapefile, as returned by `download_geography_boundaries`
+        batch_size (int, optional): Number of records per batch. Defaults to 2000.
+
+    Yields:
+        gpd.GeoDataFrame: The next batch of boundaries, indexed by record number
+    """
+    with fiona.open(f"zip://{path}") as source:
+        columns = list(source.schema["properties"]) + ["geometry"]
+        offset = 0
+        for features in batched(source, batch_size):
+            batch = gpd.GeoDataFrame.from_features(
+                features, crs=source.crs, columns=columns)
+            batch.index = pd.RangeIndex(offset, offset + len(batch))
+            offset += len(batch)
+            yield batch
 
 
 def extract_zip_to_cbsa() -> pd.DataFrame:
     # Read in cross walk data
     url = "https://www.huduser.gov/hudapi/public/usps?type=8&query=All"
-    token = os.environ["US_CENSUS_CROSSWALK_API_KEY"]
+    token = os.getenv("US_CENSUS_CROSSWALK_API_KEY")
     headers = {"Authorization": "Bearer {0}".format(token)}
 
-    response = requests.get(url, headers=headers)
+    response = cached_get(url, headers=headers)
 
     if response.status_code != 200:
         logger.error("Failure, see status code: {0}".format(
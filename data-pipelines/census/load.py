@@ -1,12 +1,34 @@
+import io
 import os
+import struct
+from functools import lru_cache
+from typing import Iterable
 
+import geopandas as gpd
 import pandas as pd
+import shapely
+from geopandas.array import GeometryDtype
 from loguru import logger
 from sqlalchemy import create_engine, text
-from sqlalchemy.engine.base import Connection
+from sqlalchemy.engine.base import Connection, Engine
+from sqlalchemy.pool import NullPool
 
+# PostgreSQL binary COPY framing, see https://www.postgresql.org/docs/current/sql-copy.html
+COPY_BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+COPY_BINARY_TRAILER = struct.pack(">h", -1)
+COPY_NULL = struct.pack(">i", -1)
 
-def init_connection() -> Connection:
+
+@lru_cache(maxsize=None)
+def get_engine() -> Engine:
+    """Returns the engine shared by every pipeline stage in this process. Each
+    stage checks a connection out of its pool instead of building a new engine.
+
+    The pool holds `POSTGRES_POOL_SIZE` connections, by default one per stage
+    running at once (`PIPELINE_WORKERS`), plus `POSTGRES_MAX_OVERFLOW` (default
+    `5`) opened while a stage holds more than one. A stage waits at most
+    `POSTGRES_POOL_TIMEOUT` seconds (default `30`) for a connection.
+    """
     db_user = os.getenv('POSTGRES_USER')
     db_pass = os.getenv('POSTGRES_PASSWORD')
     db_host = os.getenv('POSTGRES_HOST')
@@ -14,30 +36,226 @@ def init_connection() -> Connection:
     db_name = os.getenv('POSTGRES_DB')
 
     conn_string = f"postgresql://{db_user}:{db_pass}@{db_host}:{db_port}/{db_name}"
-    engine = create_engine(url=conn_string)
-    conn = engine.connect()
+    if os.getenv("PGBOUNCER", "false").lower() == "true":
+        # PgBouncer already keeps its connections open
+        return create_engine(url=conn_string, poolclass=NullPool)
+    engine = create_engine(url=conn_string,
+                           pool_size=int(os.getenv("POSTGRES_POOL_SIZE",
+                                                   os.getenv("PIPELINE_WORKERS", 4))),
+                           max_overflow=int(
+                               os.getenv("POSTGRES_MAX_OVERFLOW", 5)),
+                           pool_timeout=int(
+                               os.getenv("POSTGRES_POOL_TIMEOUT", 30)),
+                           pool_pre_ping=True)
+    return engine
+
+
+def init_connection() -> Connection:
+    conn = get_engine().connect()
     return conn
 
 
-def load_data(data, conn, schema_name, table_name):
-    # Dump Data into New Database Table
-    data.to_sql(table_name, conn, schema=schema_name,
-                if_exists='fail', index=True, index_label='id')
-    logger.success(f"Successfully wrote table {table_name} to DB")
+def get_srid(series: gpd.GeoSeries) -> int:
+    epsg = series.crs.to_epsg() if series.crs is not None else None
+    return epsg or 0
+
+
+def get_postgres_type(series: pd.Series) -> str:
+    """Maps a pandas column to the PostgreSQL type it is stored as
+
+    Args:
+        series (pd.Series): The column to map
+
+    Returns:
+        str: The PostgreSQL column type
+    """
+    if isinstance(series.dtype, GeometryDtype):
+        return f"geometry(Geometry, {get_srid(series)})"
+    if pd.api.types.is_bool_dtype(series):
+        return "boolean"
+    if pd.api.types.is_integer_dtype(series):
+        return "bigint"
+    if pd.api.types.is_float_dtype(series):
+        return "double precision"
+    return "text"
+
+
+def encode_column(series: pd.Series, pg_type: str, format: str) -> list:
+    """Encodes every value of a column as a COPY field of the column's table type
+
+    Args:
+        series (pd.Series): The column to encode
+        pg_type (str): The PostgreSQL type of the table column
+        format (str): "binary" or "csv"
+
+    Returns:
+        list: One `bytes` field per row, including the length prefix for binary COPY
+    """
+    is_null = series.isna().to_numpy()
+
+    if pg_type.startswith("geometry"):
+        geometries = shapely.set_srid(series.to_numpy(), get_srid(series))
+        values = shapely.to_wkb(
+            geometries, hex=format == "csv", include_srid=True)
+    else:
+        values = series.to_numpy(dtype=object)
+
+    fields = []
+    for value, null in zip(values, is_null):
+        if null:
+            fields.append(COPY_NULL if format == "binary" else b"")
+        elif format == "binary":
+            if pg_type == "boolean":
+                fields.append(struct.pack(">i?", 1, bool(value)))
+            elif pg_type == "bigint":
+                fields.append(struct.pack(">iq", 8, int(value)))
+            elif pg_type == "double precision":
+                fields.append(struct.pack(">id", 8, float(value)))
+            else:
+                value = value if isinstance(
+                    value, bytes) else str(value).encode("utf-8")
+                fields.append(struct.pack(">i", len(value)) + value)
+        else:
+            if pg_type == "boolean":
+                value = "t" if value else "f"
+            elif pg_type == "bigint":
+                value = str(int(value))
+            elif pg_type == "double precision":
+                value = repr(float(value))
+            elif pg_type == "text":
+                value = '"' + str(value).replace('"', '""') + '"'
+            fields.append(value.encode("utf-8"))
+    return fields
+
+
+def create_table(data: pd.DataFrame, conn, schema_name, table_name) -> dict:
+    """Creates an empty table with a column of the matching PostgreSQL type for each column of `data`
 
+    Returns:
+        dict: Column name -> PostgreSQL type of the created table
+    """
+    column_types = {column: get_postgres_type(
+        data[column]) for column in data.columns}
+    columns = ", ".join(
+        f'"{column}" {pg_type}' for column, pg_type in column_types.items())
+    conn.execute(text(f"CREATE TABLE {schema_name}.{table_name} ({columns});"))
+    conn.commit()
+    return column_types
+
+
+def copy_data(data: pd.DataFrame, conn, schema_name, table_name, format="binary", chunksize=10000, column_types: dict = None):
+    """Streams `data` into an existing table with `COPY ... FROM STDIN`. Rows are
+    encoded `chunksize` at a time into an in-memory buffer, so only one chunk is
+    held in encoded form at once. Geometries are sent as EWKB.
+
+    Args:
+        data (pd.DataFrame): The rows to load, with the same columns as the table
+        conn (Connection): A connection to the database
+        schema_name (str): The schema of the table
+        table_name (str): The table to load into
+        format (str, optional): "binary" or "csv". Defaults to "binary".
+        chunksize (int, optional): Number of rows per COPY buffer. Defaults to 10000.
+        column_types (dict, optional): Column name -> PostgreSQL type of the table. Inferred from `data` if not given.
+    """
+    if column_types is None:
+        column_types = {column: get_postgres_type(
+            data[column]) for column in data.columns}
+    columns = ", ".join(f'"{column}"' for column in data.columns)
+    if format == "binary":
+        copy_sql = f"COPY {schema_name}.{table_name} ({columns}) FROM STDIN WITH (FORMAT binary)"
+        field_count = struct.pack(">h", len(data.columns))
+    elif format == "csv":
+        copy_sql = f"COPY {schema_name}.{table_name} ({columns}) FROM STDIN WITH (FORMAT csv)"
+    else:
+        raise ValueError(f"Unknown COPY format {format}")
+
+    dbapi_conn = conn.connection
+    cursor = dbapi_conn.cursor()
+    for start in range(0, len(data), chunksize):
+        chunk = data.iloc[start:start + chunksize]
+        fields = [encode_column(chunk[column], column_types[column], format)
+                  for column in chunk.columns]
+
+        buffer = io.BytesIO()
+        if format == "binary":
+            buffer.write(COPY_BINARY_HEADER)
+            for row in zip(*fields):
+                buffer.write(field_count)
+                buffer.write(b"".join(row))
+            buffer.write(COPY_BINARY_TRAILER)
+        else:
+            for row in zip(*fields):
+                buffer.write(b",".join(row) + b"\n")
+        buffer.seek(0)
+
+        cursor.copy_expert(copy_sql, buffer)
+    cursor.close()
+    dbapi_conn.commit()
+
+
+def create_spatial_index(conn, schema_name, table_name, geometry_column="geometry"):
+    conn.execute(text(
+        f"CREATE INDEX ON {schema_name}.{table_name} USING gist({geometry_column});"))
+    conn.commit()
+    logger.success(f"Created spatial index on {geometry_column} column")
 
-def load_boundary_data(data, conn, schema_name, table_name):
-    data.to_postgis(table_name, conn, schema=schema_name,
-                    if_exists='fail', index=True, index_label='id', chunksize=100)
+
+def create_index(conn, schema_name, table_name, column):
+    conn.execute(text(
+        f"CREATE INDEX ON {schema_name}.{table_name} ({column});"))
+    conn.commit()
+    logger.success(f"Created index on {column} column")
+
+
+def bulk_load_batches(batches: Iterable[pd.DataFrame], conn, schema_name, table_name, format="binary"):
+    """Creates `table_name` from the first batch, loads every batch into it with
+    COPY and then adds a primary key on the `id` column taken from the DataFrame
+    index. Spatial data also gets a GiST index on its geometry column. Batches
+    are consumed one at a time, so a generator keeps memory use bounded by the
+    batch size.
+
+    Args:
+        batches (Iterable[pd.DataFrame]): The data to load. Can be GeoDataFrames.
+        conn (Connection): A connection to the database
+        schema_name (str): The schema to create the table in
+        table_name (str): The table to create
+        format (str, optional): The COPY format, "binary" or "csv". Defaults to "binary".
+
+    Raises:
+        ValueError: If `batches` is empty, as the table is created from the first batch
+    """
+    geometry_column = None
+    column_types = None
+    row_count = 0
+    for i, data in enumerate(batches):
+        data = data.rename_axis("id").reset_index()
+        if i == 0:
+            column_types = create_table(data, conn, schema_name, table_name)
+            if isinstance(data, gpd.GeoDataFrame):
+                geometry_column = data.geometry.name
+        # Later batches are encoded as the column types of the first one
+        copy_data(data, conn, schema_name, table_name, format=format,
+                  column_types=column_types)
+        row_count += len(data)
+        logger.info(f"Copied {row_count} rows into {table_name}")
+    if column_types is None:
+        raise ValueError(f"No batch of data to create {schema_name}.{table_name} from")
     logger.success(f"Successfully wrote table {table_name} to DB")
 
+    # Indexes are built after the load so they are created in one pass
+    create_pkey(conn, schema_name, table_name, index_column="id")
+    if geometry_column is not None:
+        create_spatial_index(conn, schema_name, table_name,
+                             geometry_column=geometry_column)
+
+
+def bulk_load_data(data: pd.DataFrame, conn, schema_name, table_name, format="binary"):
+    """Loads a single DataFrame with `bulk_load_batches`
+    """
+    bulk_load_batches([data], conn, schema_name, table_name, format=format)
+
 
 def create_pkey(conn, schema_name, table_name, index_column):
-    try:
-        conn = init_connection()
-        logger.success("Successfully connected to DB")
-    except Exception as e:
-        logger.error(f"Error connecting to DB: {e}")
     # Create Primary Key from Index column
     conn.execute(
         text(f'ALTER TABLE {schema_name}.{table_name} ADD PRIMARY KEY ({index_column});'))
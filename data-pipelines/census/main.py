@@ -1,32 +1,44 @@
+import argparse
 import os
 
 from dotenv import load_dotenv
 from loguru import logger
-from pipelines import (run_acs_2021_cbsa_pipeline, run_acs_2021_zcta_pipeline,
-                       run_cbsa_geography_boundary_pipeline,
-                       run_db_init_pipeline,
-                       run_polygon_simplification_pipeline,
-                       run_zcta_geography_boundary_pipeline,
-                       run_zip_to_cbsa_pipeline)
-
-try:
-    # Load Environment Variables
-    dotenv_path = os.path.dirname(__file__)
-    load_dotenv(dotenv_path)
-    logger.success("Loaded .env file")
-except:
-    logger.error("Could not load .env file")
-
-run_db_init_pipeline()
-
-run_acs_2021_zcta_pipeline()
-
-run_acs_2021_cbsa_pipeline()
-
-run_zcta_geography_boundary_pipeline()
-
-run_cbsa_geography_boundary_pipeline()
-
-run_polygon_simplification_pipeline()
-
-run_zip_to_cbsa_pipeline()
+from pipelines import ACS_YEARS, get_pipeline_stages, run_pipeline_dag
+
+if __name__ == "__main__":
+    try:
+        # Load Environment Variables
+        dotenv_path = os.path.dirname(__file__)
+        load_dotenv(dotenv_path)
+        logger.success("Loaded .env file")
+    except:
+        logger.error("Could not load .env file")
+
+    parser = argparse.ArgumentParser(
+        description="Builds the geospatial database from US Census sources")
+    parser.add_argument("--workers", type=int,
+                        default=int(os.getenv("PIPELINE_WORKERS", 4)),
+                        help="Number of pipeline stages to run at the same time")
+    parser.add_argument("--executor", choices=["thread", "process"],
+                        default=os.getenv("PIPELINE_EXECUTOR", "thread"),
+                        help="Run stages on a thread pool or a process pool")
+    parser.add_argument("--years", type=int, nargs="+",
+                        default=[int(year) for year in os.getenv("ACS_YEARS", ",".join(map(str, ACS_YEARS))).split(",")],
+                        help="ACS 5-year vintages to load, by their final year")
+    parser.add_argument("--offline", action="store_true",
+                        help="Replay every source from the local cache without using the network")
+    args = parser.parse_args()
+
+    # The database connection pool is sized for the stages running at once
+    os.environ["PIPELINE_WORKERS"] = str(args.workers)
+
+    if args.offline:
+        os.environ["PIPELINE_OFFLINE"] = "1"
+        logger.info("Running offline from the local cache")
+
+    status = run_pipeline_dag(stages=get_pipeline_stages(args.years),
+                              max_workers=args.workers,
+                              executor=args.executor)
+
+    if any(result != "success" for result in status.values()):
+        raise SystemExit(1)
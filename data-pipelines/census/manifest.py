@@ -0,0 +1,234 @@
+import hashlib
+import json
+from typing import Callable
+
+import pandas as pd
+from load import init_connection
+from loguru import logger
+from sqlalchemy import text
+
+MANIFEST_TABLE = "geospatial.pipeline_manifest"
+
+# Advanced every time a stage completes, so readers caching data built from the
+# tables can tell it changed. Unlike the manifest's timestamps it never goes back.
+DATA_VERSION_SEQUENCE = "geospatial.pipeline_data_version"
+
+
+def create_manifest_table(conn):
+    """Creates the table recording the source hash, row count and status of every
+    pipeline stage, and the sequence counting the stages completed
+    """
+    conn.execute(text(f"""
+    create table if not exists {MANIFEST_TABLE} (
+        stage text primary key,
+        table_name text not null,
+        source_hash text,
+        row_count bigint,
+        status text not null,
+        started_at timestamptz,
+        completed_at timestamptz
+    );
+    """))
+    conn.execute(text(f"create sequence if not exists {DATA_VERSION_SEQUENCE};"))
+    conn.commit()
+    logger.success("Successfully created pipeline manifest table")
+
+
+def combine_hashes(*parts) -> str:
+    """Hashes the source hashes and parameters a stage's output depends on into a single hash
+    """
+    combined = json.dumps([str(part) for part in parts])
+    return hashlib.sha256(combined.encode("utf-8")).hexdigest()
+
+
+def hash_dataframe(data: pd.DataFrame) -> str:
+    row_hashes = pd.util.hash_pandas_object(data, index=False).to_numpy()
+    return combine_hashes(list(data.columns), hashlib.sha256(row_hashes.tobytes()).hexdigest())
+
+
+def get_stage_record(conn, stage_name: str) -> dict:
+    result = conn.execute(
+        text(f"select * from {MANIFEST_TABLE} where stage = :stage"),
+        {"stage": stage_name}).mappings().first()
+    return dict(result) if result is not None else None
+
+
+def get_upstream_hash(conn, stage_names: list, *parameters) -> str:
+    """The source hash of a stage built from other stages' tables, which changes whenever one of them is rebuilt
+    """
+    hashes = []
+    for stage_name in stage_names:
+        record = get_stage_record(conn, stage_name)
+        hashes.append(record["source_hash"] if record is not None else None)
+    return combine_hashes(*hashes, *parameters)
+
+
+def table_exists(conn, schema_name: str, table_name: str) -> bool:
+    return conn.execute(text("select to_regclass(:name) is not null"),
+                        {"name": f"{schema_name}.{table_name}"}).scalar()
+
+
+def record_stage(conn, stage_name: str, table_name: str, status: str, source_hash: str = None, row_count: int = None):
+    conn.execute(text(f"""
+    insert into {MANIFEST_TABLE} (stage, table_name, source_hash, row_count, status, started_at, completed_at)
+    values (:stage, :table_name, :source_hash, :row_count, :status, now(),
+            case when :status = 'completed' then now() end)
+    on conflict (stage) do update set
+        table_name = excluded.table_name,
+        source_hash = coalesce(excluded.source_hash, {MANIFEST_TABLE}.source_hash),
+        row_count = coalesce(excluded.row_count, {MANIFEST_TABLE}.row_count),
+        status = excluded.status,
+        started_at = case when excluded.status = 'running'
+            then excluded.started_at else {MANIFEST_TABLE}.started_at end,
+        completed_at = excluded.completed_at;
+    """), {"stage": stage_name, "table_name": table_name, "source_hash": source_hash,
+           "row_count": row_count, "status": status})
+    if status == "completed":
+        conn.execute(text(f"select nextval('{DATA_VERSION_SEQUENCE}')"))
+    conn.commit()
+
+
+def swap_staging_table(conn, schema_name: str, table_name: str):
+    """Replaces `table_name` with its staging table. Committed as a single
+    transaction by the caller, so readers see either the old or the new table
+    and never a partial one.
+    Indexes keep the names they would have had if built on `table_name`.
+    """
+    staging_table_name = f"{table_name}__staging"
+    conn.execute(
+        text(f"drop table if exists {schema_name}.{table_name};"))
+    conn.execute(
+        text(f"alter table {schema_name}.{staging_table_name} rename to {table_name};"))
+    index_names = conn.execute(text(
+        "select indexname from pg_indexes where schemaname = :schema and tablename = :table"),
+        {"schema": schema_name, "table": table_name}).scalars().all()
+    for index_name in index_names:
+        if staging_table_name in index_name:
+            conn.execute(text(
+                f"alter index {schema_name}.{index_name} rename to {index_name.replace(staging_table_name, table_name)};"))
+
+
+def get_column_types(conn, schema_name: str, table_name: str) -> dict:
+    return dict(conn.execute(text("""
+    select attname, format_type(atttypid, atttypmod) from pg_attribute
+    where attrelid = to_regclass(:name) and attnum > 0 and not attisdropped
+    """), {"name": f"{schema_name}.{table_name}"}).all())
+
+
+# Numeric column types from the narrowest to the widest, each holding every value of those before it
+NUMERIC_TYPES = ["smallint", "integer", "bigint", "numeric", "double precision"]
+
+
+def is_lossless_cast(source: str, target: str) -> bool:
+    """Whether every value of a `source` column can be stored in a `target` column
+    """
+    if source == target or target == "text":
+        return True
+    return (source in NUMERIC_TYPES and target in NUMERIC_TYPES
+            and NUMERIC_TYPES.index(source) < NUMERIC_TYPES.index(target))
+
+
+def attach_staging_partition(conn, schema_name: str, table_name: str, parent_table_name: str, partition_value, partition_key: str = "year"):
+    """Swaps the staging table in as the `partition_value` partition of
+    `parent_table_name`, creating the parent from it if needed. A check
+    constraint on the staging table lets the attach skip scanning it, so the
+    parent is only locked for the catalog changes and queries against the
+    other partitions are not held up by the load.
+    """
+    staging_table_name = f"{table_name}__staging"
+    # Vintages are attached concurrently, and create table if not exists is not safe
+    # against a concurrent create, so they take turns until their transaction commits
+    conn.execute(text("select pg_advisory_xact_lock(hashtext(:name))"),
+                 {"name": f"{schema_name}.{parent_table_name}"})
+    conn.execute(text(
+        f"alter table {schema_name}.{staging_table_name} add constraint {staging_table_name}_{partition_key}_check check ({partition_key} = {partition_value});"))
+    conn.execute(text(f"""
+    create table if not exists {schema_name}.{parent_table_name}
+        (like {schema_name}.{staging_table_name}) partition by list ({partition_key});
+    """))
+
+    # Vintages can infer different types for a column (e.g. bigint in one, float in another),
+    # which attach would refuse. Altering the parent would rewrite every attached partition
+    # under an exclusive lock, so only the staging table is cast to the parent's types.
+    parent_types = get_column_types(conn, schema_name, parent_table_name)
+    staging_types = get_column_types(conn, schema_name, staging_table_name)
+    for column, parent_type in parent_types.items():
+        staging_type = staging_types.get(column)
+        if staging_type is None or staging_type == parent_type:
+            continue
+        if not is_lossless_cast(staging_type, parent_type):
+            raise ValueError(
+                f"Column {column} of {staging_table_name} is {staging_type}, which can't be stored in "
+                f"{parent_type} without losing values. Migrate {schema_name}.{parent_table_name} first.")
+        conn.execute(text(
+            f'alter table {schema_name}.{staging_table_name} alter column "{column}" type {parent_type} using "{column}"::{parent_type};'))
+
+    swap_staging_table(conn, schema_name, table_name)
+    conn.execute(text(
+        f"alter table {schema_name}.{table_name} rename constraint {staging_table_name}_{partition_key}_check to {table_name}_{partition_key}_check;"))
+    conn.execute(text(
+        f"alter table {schema_name}.{parent_table_name} attach partition {schema_name}.{table_name} for values in ({partition_value});"))
+
+
+def run_stage(stage_name: str, table_name: str, source_hash: str, build: Callable, schema_name: str = "geospatial",
+              partition_of: str = None, partition_value=None) -> bool:
+    """Builds a stage's table unless the manifest shows it was already built from
+    the same source. The table is built as `<table_name>__staging` and swapped in
+    once complete, so a failed or interrupted run never replaces good data.
+
+    Args:
+        stage_name (str): The stage's name in the manifest
+        table_name (str): The table the stage produces
+        source_hash (str): A hash of everything the table is built from
+        build (Callable): Called as `build(conn, staging_table_name)`; must create and fully load the staging table
+        schema_name (str, optional): The schema of the table. Defaults to "geospatial".
+        partition_of (str, optional): A table partitioned by year the table is attached to. Defaults to None.
+        partition_value (optional): The year of the partition. Defaults to None.
+
+    Returns:
+        bool: True if the table was rebuilt, False if it was up to date
+    """
+    conn = init_connection()
+    try:
+        record = get_stage_record(conn, stage_name)
+        if (record is not None and record["status"] == "completed"
+                and record["source_hash"] == source_hash
+                and table_exists(conn, schema_name, table_name)):
+            logger.info(
+                f"Source of {table_name} is unchanged. Skipping stage {stage_name}.")
+            return False
+
+        logger.info(f"Building {table_name} for stage {stage_name}...")
+        record_stage(conn, stage_name, table_name, status="running")
+
+        staging_table_name = f"{table_name}__staging"
+        conn.execute(
+            text(f"drop table if exists {schema_name}.{staging_table_name};"))
+        conn.commit()
+
+        build(conn, staging_table_name)
+        # Some builders commit through the raw DBAPI connection
+        conn.commit()
+
+        row_count = conn.execute(
+            text(f"select count(*) from {schema_name}.{staging_table_name}")).scalar()
+        if partition_of is None:
+            swap_staging_table(conn, schema_name, table_name)
+        else:
+            attach_staging_partition(conn, schema_name, table_name,
+                                     partition_of, partition_value)
+        conn.commit()
+        record_stage(conn, stage_name, table_name, status="completed",
+                     source_hash=source_hash, row_count=row_count)
+        logger.success(
+            f"Successfully swapped in {table_name} ({row_count} rows)")
+        return True
+
+    except Exception as e:
+        logger.error(f"Stage {stage_name} failed: {e}")
+        conn.rollback()
+        record_stage(conn, stage_name, table_name, status="failed")
+        raise
+
+    finally:
+        conn.close()
@@ -1,12 +1,25 @@
-import pandas as pd
-from extract import (extract_2021_acs_5_year_data,
-                     extract_geography_boundaries, extract_zip_to_cbsa)
-from load import create_pkey, init_connection, load_boundary_data, load_data
+import os
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from functools import partial
+
+import geopandas as gpd
+from artifacts import (ARTIFACT_DIR, GEOJSON_PRECISION, publish_artifacts,
+                       write_geojson, write_geoparquet)
+from extract import (download_geography_boundaries, extract_acs_5_year_data,
+                     extract_zip_to_cbsa, iter_geography_boundaries)
+from load import (bulk_load_batches, bulk_load_data, create_index, create_pkey,
+                  init_connection)
 from loguru import logger
-from transform import clean_census_data, get_human_readable_columns
+from manifest import (create_manifest_table, get_upstream_hash, hash_dataframe,
+                      record_stage, run_stage)
+from transform import (clean_census_data, get_human_readable_columns,
+                       get_variable_codes, iter_topojson_batches)
 
-from utils import (create_geospatial_schema, create_postgis_extension,
-                   create_simplified_polygons, is_table_initialized)
+from utils import (ACS_DISPLAY_METRICS, ACS_METRICS, BOUNDARY_SRID,
+                   GEOMETRY_LEVELS_OF_DETAIL, create_acs_metrics_table,
+                   create_geospatial_schema, create_postgis_extension, create_simplified_polygons,
+                   create_zcta_cbsa_membership_table, iter_cbsa_zcta_boundaries)
 
 
 def run_db_init_pipeline():
@@ -23,260 +36,373 @@ def run_db_init_pipeline():
     # Create Geospatial Schema
     create_geospatial_schema(conn)
 
+    # Create the table tracking what each stage was built from
+    create_manifest_table(conn)
+
     # Close DB Connection
     conn.close()
 
 
-def run_acs_2021_zcta_pipeline():
-    # Check if table is already initialized
-    if not is_table_initialized("geospatial.acs_census_2021_zcta"):
-        try:
-            r = extract_2021_acs_5_year_data(geography="zcta")
-            logger.success(
-                "Successfully read 2021 ACS data from the US Census")
-        except Exception as e:
-            logger.error(
-                f"Error reading 2021 ACS data from the US Census: {e}")
-
-        try:
-            data = clean_census_data(r, geography="zcta")
-            logger.success("Data cleaned successfully")
-        except Exception as e:
-            logger.error(f"Error cleaning data: {e}")
-
-        try:
-            data = get_human_readable_columns(
-                "https://api.census.gov/data/2021/acs/acs5/profile/variables.json", data)
-            # Do some manual column cleaning to avoid PostgreSQL errors
-
-            data.rename(columns={
-                "percent_house_heating_fuel_occupied_housing_units_bottled_tank_or_lp_gas": "percent_house_heating_fuel_occupied_housing_units_gas_tank",
-                "percent_house_heating_fuel_occupied_housing_units_fuel_oil_kerosene_etc.": "percent_house_heating_fuel_occupied_housing_units_fuel_oil"
-            }, inplace=True)
-
-            logger.success("Data columns cleaned successfully")
-        except Exception as e:
-            logger.error(f"Error cleaning data columns: {e}")
-
-        # Create DB Connection
-        try:
-            conn = init_connection()
-            logger.success("Successfully connected to DB")
-        except Exception as e:
-            logger.error(f"Error connecting to DB: {e}")
-
-        try:
-            data = data[[
-                "zcta",
-                "est_gross_rent_occupied_units_paying_rent_median_dollars",
-                "percent_housing_tenure_occupied_housing_units_renter_occupied",
-                "percent_house_heating_fuel_occupied_housing_units_electricity",
-                "percent_house_heating_fuel_occupied_housing_units_other_fuel",
-                "percent_house_heating_fuel_occupied_housing_units_fuel_oil",
-                "percent_house_heating_fuel_occupied_housing_units_no_fuel_used",
-                "percent_house_heating_fuel_occupied_housing_units_coal_or_coke",
-                "percent_house_heating_fuel_occupied_housing_units_solar_energy",
-                "percent_house_heating_fuel_occupied_housing_units_wood",
-                "percent_house_heating_fuel_occupied_housing_units_gas_tank",
-                "est_value_owner_occupied_units_median_dollars"
-            ]]
-            logger.debug(f"Columns:\n{data.columns}")
-            load_data(data, conn, schema_name="geospatial",
-                      table_name="acs_census_2021_zcta")
-        except Exception as e:
-            logger.error(
-                f"Error writing table acs_census_2021_zcta to DB: {e}")
-
-        try:
-            create_pkey(conn, schema_name="geospatial", table_name="acs_census_2021_zcta",
-                        index_column="id")
-        except Exception as e:
-            logger.error(f"Error creating primary key: {e}")
-
-        # Close DB Connection
-        conn.close()
+# The ACS 5-year vintages loaded by default, each into its own partition
+ACS_YEARS = [2020, 2021]
 
 
-def run_acs_2021_cbsa_pipeline():
-    # Check if table is already initialized
-    if not is_table_initialized("geospatial.acs_census_2021_cbsa"):
-        try:
-            r = extract_2021_acs_5_year_data(geography="cbsa")
-            logger.success(
-                "Successfully read 2021 ACS data from the US Census")
-        except Exception as e:
-            logger.error(
-                f"Error reading 2021 ACS data from the US Census: {e}")
-
-        try:
-            data = clean_census_data(r, geography="cbsa")
-            logger.success("Data cleaned successfully")
-        except Exception as e:
-            logger.error(f"Error cleaning data: {e}")
-
-        try:
-            data = get_human_readable_columns(
-                "https://api.census.gov/data/2021/acs/acs5/profile/variables.json", data)
-
-            # Do some manual column cleaning to avoid PostgreSQL errors
-            data.rename(columns={
-                "percent_house_heating_fuel_occupied_housing_units_bottled_tank_or_lp_gas": "percent_house_heating_fuel_occupied_housing_units_gas_tank",
-                "percent_house_heating_fuel_occupied_housing_units_fuel_oil_kerosene_etc.": "percent_house_heating_fuel_occupied_housing_units_fuel_oil"
-            }, inplace=True)
-
-            logger.success("Data columns cleaned successfully")
-        except Exception as e:
-            logger.error(f"Error cleaning data columns: {e}")
-
-        # Create DB Connection
-        try:
-            conn = init_connection()
-            logger.success("Successfully connected to DB")
-        except Exception as e:
-            logger.error(f"Error connecting to DB: {e}")
-
-        try:
-            # Select only the columns we want
-            data = data[[
-                "cbsa",
-                "est_gross_rent_occupied_units_paying_rent_median_dollars",
-                "percent_housing_tenure_occupied_housing_units_renter_occupied",
-                "percent_house_heating_fuel_occupied_housing_units_electricity",
-                "percent_house_heating_fuel_occupied_housing_units_other_fuel",
-                "percent_house_heating_fuel_occupied_housing_units_fuel_oil",
-                "percent_house_heating_fuel_occupied_housing_units_no_fuel_used",
-                "percent_house_heating_fuel_occupied_housing_units_coal_or_coke",
-                "percent_house_heating_fuel_occupied_housing_units_solar_energy",
-                "percent_house_heating_fuel_occupied_housing_units_wood",
-                "percent_house_heating_fuel_occupied_housing_units_gas_tank",
-                "est_value_owner_occupied_units_median_dollars"
-            ]]
-            load_data(data, conn, schema_name="geospatial",
-                      table_name="acs_census_2021_cbsa")
-        except Exception as e:
-            logger.error(
-                f"Error writing table acs_census_2021_cbsa to DB: {e}")
-
-        try:
-            create_pkey(conn, schema_name="geospatial", table_name="acs_census_2021_cbsa",
-                        index_column="id")
-        except Exception as e:
-            logger.error(f"Error creating primary key on id column: {e}")
-
-        # Close DB Connection
-        conn.close()
+def get_acs_variables_url(year=2021) -> str:
+    return f"https://api.census.gov/data/{year}/acs/acs5/profile/variables.json"
+
+
+# Do some manual column cleaning to avoid PostgreSQL errors
+ACS_COLUMN_RENAMES = {
+    "percent_house_heating_fuel_occupied_housing_units_bottled_tank_or_lp_gas": "percent_house_heating_fuel_occupied_housing_units_gas_tank",
+    "percent_house_heating_fuel_occupied_housing_units_fuel_oil_kerosene_etc.": "percent_house_heating_fuel_occupied_housing_units_fuel_oil"
+}
+
+# The DP04 metrics stored for each geography, those the display metrics are computed from
+ACS_METRIC_COLUMNS = list(dict.fromkeys(
+    column for config in ACS_METRICS.values() for column in config["source_columns"]))
+
+
+def run_acs_pipeline(geography="zcta", year=2021):
+    table_name = f"acs_census_{geography}_{year}"
+    variables_url = get_acs_variables_url(year)
+
+    # Only request the DP04 variables behind the metrics we store
+    variables = get_variable_codes(
+        variables_url, ACS_METRIC_COLUMNS, renames=ACS_COLUMN_RENAMES)
+    rows = extract_acs_5_year_data(variables, geography=geography, year=year)
+    logger.success(f"Successfully read {year} ACS data from the US Census")
+
+    data = clean_census_data(rows, geography=geography, variables=variables)
+    logger.success("Data cleaned successfully")
+
+    data = get_human_readable_columns(variables_url, data)
+    data.rename(columns=ACS_COLUMN_RENAMES, inplace=True)
+    logger.success("Data columns cleaned successfully")
+
+    # Select only the columns we want
+    data = data[[geography] + ACS_METRIC_COLUMNS]
+    data.insert(0, "year", year)
+    logger.debug(f"Columns:\n{data.dtypes}")
+
+    def build(conn, staging_table_name):
+        bulk_load_data(data, conn, schema_name="geospatial",
+                       table_name=staging_table_name)
+
+    # The chunks arrive in any order, so hash the merged data rather than the responses
+    run_stage(f"acs_{geography}_{year}", table_name, hash_dataframe(data), build,
+              partition_of=f"acs_census_{geography}", partition_value=year)
+
+
+def run_acs_metrics_pipeline(geography="zcta", year=2021):
+    table_name = f"acs_metrics_{geography}_{year}"
+
+    conn = init_connection()
+    source_hash = get_upstream_hash(
+        conn, [f"acs_{geography}_{year}"], ACS_DISPLAY_METRICS)
+    conn.close()
+
+    def build(conn, staging_table_name):
+        create_acs_metrics_table(conn, schema_name="geospatial",
+                                 table_name=staging_table_name, geography=geography, year=year)
+        create_pkey(conn, schema_name="geospatial", table_name=staging_table_name,
+                    index_column="id")
+
+    run_stage(f"acs_{geography}_{year}_metrics", table_name, source_hash, build,
+              partition_of=f"acs_metrics_{geography}", partition_value=year)
+
+
+# The column identifying each boundary of a geography
+BOUNDARY_KEY_COLUMNS = {
+    "zcta": '"ZCTA5CE20"',
+    "cbsa": '"CBSAFP"',
+}
+
+
+def run_geography_boundary_pipeline(geography="zcta"):
+    table_name = f"{geography}_boundaries_2021"
+
+    # The cached zip is named by the hash of its content
+    path = download_geography_boundaries(geography=geography)
+    source_hash = os.path.basename(path)
+
+    def build(conn, staging_table_name):
+        # Stream the Geo Data in batches
+        geo_batches = iter_geography_boundaries(path)
+        bulk_load_batches(geo_batches, conn, schema_name="geospatial",
+                          table_name=staging_table_name)
+        # Other stages join the boundaries on their code
+        create_index(conn, schema_name="geospatial", table_name=staging_table_name,
+                     column=BOUNDARY_KEY_COLUMNS[geography])
+
+    run_stage(f"{geography}_boundaries", table_name, source_hash, build)
 
 
 def run_zcta_geography_boundary_pipeline():
-    # Check if table is already initialized
-    if not is_table_initialized("geospatial.zcta_boundaries_2021"):
-        # Read in ZCTA and CBSA Geo Data
-        zcta_geo_data = extract_geography_boundaries(geography="zcta")
-
-        # Create DB Connection
-        try:
-            conn = init_connection()
-            logger.success("Successfully connected to DB")
-        except Exception as e:
-            logger.error(f"Error connecting to DB: {e}")
-
-        try:
-            # Load Data into DB
-            load_boundary_data(zcta_geo_data, conn, schema_name="geospatial",
-                               table_name="zcta_boundaries_2021")
-        except Exception as e:
-            logger.error(
-                f"Error writing table zcta_boundaries_2021 to DB: {e}")
-
-        try:
-            create_pkey(conn, schema_name="geospatial", table_name="zcta_boundaries_2021",
-                        index_column="id")
-        except Exception as e:
-            logger.error(f"Error creating primary key: {e}")
+    run_geography_boundary_pipeline(geography="zcta")
 
 
 def run_cbsa_geography_boundary_pipeline():
-    # Check if table is already initialized
-    if not is_table_initialized("geospatial.cbsa_boundaries_2021"):
-        # Read in ZCTA and CBSA Geo Data
-        cbsa_geo_data = extract_geography_boundaries(geography="cbsa")
-
-        # Create DB Connection
-        try:
-            conn = init_connection()
-            logger.success("Successfully connected to DB")
-        except Exception as e:
-            logger.error(f"Error connecting to DB: {e}")
-
-        try:
-            # Load Data into DB
-            load_boundary_data(cbsa_geo_data, conn, schema_name="geospatial",
-                               table_name="cbsa_boundaries_2021")
-        except Exception as e:
-            logger.error(
-                f"Error writing table cbsa_boundaries_2021 to DB: {e}")
-
-        try:
-            create_pkey(conn, schema_name="geospatial", table_name="cbsa_boundaries_2021",
-                        index_column="id")
-        except Exception as e:
-            logger.error(f"Error creating primary key: {e}")
-
-
-def run_polygon_simplification_pipeline():
-    for geography in ["ZCTA", "CBSA"]:
-        table_name = f"geospatial.{geography.lower()}_boundaries_2021_simplified"
-        # Check if table is already initialized
-        if not is_table_initialized(table_name):
-            # Create DB Connection
-            try:
-                conn = init_connection()
-                logger.success("Successfully connected to DB")
-            except Exception as e:
-                logger.error(f"Error connecting to DB: {e}")
-
-            try:
-                # Create new table with simplified polygons
-                create_simplified_polygons(
-                    conn, tolerance=0.001, geographic_granularity=geography)
-                logger.success(
-                    f"Successfully created table {table_name}")
-            except Exception as e:
-                logger.error(
-                    f"Error creating table {table_name}: {e}")
-
-            try:
-                create_pkey(conn, schema_name="geospatial", table_name=table_name,
-                            index_column="id")
-            except Exception as e:
-                logger.error(f"Error creating primary key: {e}")
-
-            # Close DB Connection
-            conn.close()
+    run_geography_boundary_pipeline(geography="cbsa")
+
+
+def run_polygon_simplification_pipeline(geography="ZCTA", levels_of_detail=GEOMETRY_LEVELS_OF_DETAIL):
+    table_name = f"{geography.lower()}_boundaries_2021_simplified"
+
+    conn = init_connection()
+    source_hash = get_upstream_hash(
+        conn, [f"{geography.lower()}_boundaries"], levels_of_detail, BOUNDARY_SRID)
+    conn.close()
+
+    def build(conn, staging_table_name):
+        # Create new table with the polygons simplified at every level of detail
+        create_simplified_polygons(conn, table_name=staging_table_name,
+                                   levels_of_detail=levels_of_detail, geographic_granularity=geography)
+        create_pkey(conn, schema_name="geospatial", table_name=staging_table_name,
+                    index_column="id")
+
+    run_stage(f"{geography.lower()}_simplification",
+              table_name, source_hash, build)
+
+
+def run_zcta_polygon_simplification_pipeline():
+    run_polygon_simplification_pipeline(geography="ZCTA")
+
+
+def run_cbsa_polygon_simplification_pipeline():
+    run_polygon_simplification_pipeline(geography="CBSA")
+
+
+def run_zcta_cbsa_membership_pipeline():
+    table_name = "zcta_cbsa_membership"
+
+    conn = init_connection()
+    source_hash = get_upstream_hash(
+        conn, ["zip_to_cbsa", "zcta_boundaries", "cbsa_simplification"])
+    conn.close()
+
+    def build(conn, staging_table_name):
+        create_zcta_cbsa_membership_table(conn, schema_name="geospatial",
+                                          table_name=staging_table_name)
+
+    run_stage("zcta_cbsa_membership", table_name, source_hash, build)
+
+
+def run_zcta_topojson_pipeline(levels_of_detail=GEOMETRY_LEVELS_OF_DETAIL, batch_size=50):
+    table_name = "zcta_topojson_2021"
+    # Simplify as much as the drill-down map's level of detail
+    tolerance = levels_of_detail["geometry_medium"]
+
+    conn = init_connection()
+    source_hash = get_upstream_hash(
+        conn, ["zcta_boundaries", "zcta_cbsa_membership"], tolerance)
+    conn.close()
+
+    def build(conn, staging_table_name):
+        # One row per CBSA, holding the topology of its ZCTAs
+        topojson_batches = iter_topojson_batches(iter_cbsa_zcta_boundaries(conn), tolerance=tolerance,
+                                                 batch_size=batch_size)
+        bulk_load_batches(topojson_batches, conn, schema_name="geospatial",
+                          table_name=staging_table_name)
+        create_index(conn, schema_name="geospatial",
+                     table_name=staging_table_name, column="cbsa")
+
+    run_stage("zcta_topojson", table_name, source_hash, build)
+
+
+def read_boundaries(conn, query: str, levels_of_detail=GEOMETRY_LEVELS_OF_DETAIL) -> gpd.GeoDataFrame:
+    """Reads simplified boundaries with every level of detail as a geometry column
+    """
+    data = gpd.read_postgis(query, con=conn, geom_col="geometry")
+    for column in levels_of_detail:
+        if column != "geometry":
+            data[column] = gpd.GeoSeries.from_wkb(data[column], crs=data.crs)
+    return data
+
+
+def write_boundary_artifacts(conn, directory: str):
+    cbsa_boundaries = read_boundaries(conn, f"""
+    select
+        "CBSAFP" as cbsa_code
+        , "NAMELSAD" as cbsa
+        , {", ".join(GEOMETRY_LEVELS_OF_DETAIL)}
+    from geospatial.cbsa_boundaries_2021_simplified
+    order by "NAMELSAD"
+    """)
+    write_geoparquet(cbsa_boundaries, os.path.join(
+        directory, "cbsa_boundaries.parquet"))
+    # The national map is drawn with the coarsest level of detail
+    write_geojson(cbsa_boundaries[["cbsa", "geometry_coarse"]].set_geometry("geometry_coarse"),
+                  os.path.join(directory, "cbsa_boundaries.geojson"))
+    logger.success(f"Wrote {len(cbsa_boundaries)} CBSA boundaries")
+
+    # Sorted by CBSA so reading one CBSA only touches its row groups
+    zcta_boundaries = read_boundaries(conn, f"""
+    select
+        zcta_cbsa_membership.zcta
+        , zcta_cbsa_membership.cbsa_code
+        , zcta_cbsa_membership.cbsa
+        , {", ".join(f"zcta_boundaries_2021_simplified.{column}" for column in GEOMETRY_LEVELS_OF_DETAIL)}
+    from geospatial.zcta_cbsa_membership
+        inner join geospatial.zcta_boundaries_2021_simplified
+            on zcta_boundaries_2021_simplified."ZCTA5CE20" = zcta_cbsa_membership.zcta
+    order by cbsa, zcta
+    """)
+    write_geoparquet(zcta_boundaries, os.path.join(
+        directory, "zcta_boundaries.parquet"))
+    # The drill-down map is drawn with the medium level of detail
+    for cbsa_code, zctas in zcta_boundaries.groupby("cbsa_code"):
+        write_geojson(zctas[["zcta", "geometry_medium"]].set_geometry("geometry_medium"),
+                      os.path.join(directory, "zcta_boundaries", f"{cbsa_code}.geojson"))
+    logger.success(f"Wrote {len(zcta_boundaries)} ZCTA boundaries")
+
+
+def run_boundary_artifacts_pipeline():
+    conn = init_connection()
+    try:
+        source_hash = get_upstream_hash(
+            conn, ["cbsa_simplification", "zcta_simplification", "zcta_cbsa_membership"], GEOMETRY_LEVELS_OF_DETAIL,
+            GEOJSON_PRECISION)
+        record_stage(conn, "boundary_artifacts", ARTIFACT_DIR, status="running")
+        publish_artifacts(source_hash,
+                          lambda directory: write_boundary_artifacts(conn, directory))
+        record_stage(conn, "boundary_artifacts", ARTIFACT_DIR, status="completed",
+                     source_hash=source_hash)
+    except Exception as e:
+        logger.error(f"Stage boundary_artifacts failed: {e}")
+        conn.rollback()
+        record_stage(conn, "boundary_artifacts", ARTIFACT_DIR, status="failed")
+        raise
+    finally:
+        conn.close()
 
 
 def run_zip_to_cbsa_pipeline():
-    if not is_table_initialized("geospatial.zip_to_cbsa"):
-
-        zip_to_cbsa = extract_zip_to_cbsa()
-
-        # Create DB Connection
-        try:
-            conn = init_connection()
-            logger.success("Successfully connected to DB")
-        except Exception as e:
-            logger.error(f"Error connecting to DB: {e}")
-
-        try:
-            # Load Data into DB
-            load_data(zip_to_cbsa, conn, schema_name="geospatial",
-                      table_name="zip_to_cbsa")
-        except Exception as e:
-            logger.error(
-                f"Error writing table zip_to_cbsa to DB: {e}")
-
-        try:
-            create_pkey(conn, schema_name="geospatial", table_name="zip_to_cbsa",
-                        index_column="id")
-        except Exception as e:
-            logger.error(f"Error creating primary key: {e}")
+    zip_to_cbsa = extract_zip_to_cbsa()
+    source_hash = hash_dataframe(zip_to_cbsa)
+
+    def build(conn, staging_table_name):
+        # Load Data into DB
+        bulk_load_data(zip_to_cbsa, conn, schema_name="geospatial",
+                       table_name=staging_table_name)
+
+    run_stage("zip_to_cbsa", "zip_to_cbsa", source_hash, build)
+
+
+def get_pipeline_stages(years: list) -> dict:
+    """Builds the stage graph for the given ACS vintages. Each stage maps to the
+    function that runs it and the stages whose tables it needs. Stages without a
+    path between them in this graph run concurrently.
+    """
+    stages = {
+        "db_init": (run_db_init_pipeline, []),
+        "zcta_boundaries": (run_zcta_geography_boundary_pipeline, ["db_init"]),
+        "cbsa_boundaries": (run_cbsa_geography_boundary_pipeline, ["db_init"]),
+        "zcta_simplification": (run_zcta_polygon_simplification_pipeline, ["zcta_boundaries"]),
+        "cbsa_simplification": (run_cbsa_polygon_simplification_pipeline, ["cbsa_boundaries"]),
+        "zip_to_cbsa": (run_zip_to_cbsa_pipeline, ["db_init"]),
+        "zcta_cbsa_membership": (run_zcta_cbsa_membership_pipeline, ["zip_to_cbsa", "zcta_boundaries", "cbsa_simplification"]),
+        "zcta_topojson": (run_zcta_topojson_pipeline, ["zcta_boundaries", "zcta_cbsa_membership"]),
+        "boundary_artifacts": (run_boundary_artifacts_pipeline, ["zcta_simplification", "cbsa_simplification", "zcta_cbsa_membership"]),
+    }
+    for year in years:
+        for geography in ["zcta", "cbsa"]:
+            # partial keeps the stage picklable for the process executor
+            stages[f"acs_{geography}_{year}"] = (
+                partial(run_acs_pipeline, geography=geography, year=year), ["db_init"])
+            stages[f"acs_{geography}_{year}_metrics"] = (
+                partial(run_acs_metrics_pipeline, geography=geography, year=year), [f"acs_{geography}_{year}"])
+    return stages
+
+
+PIPELINE_STAGES = get_pipeline_stages(ACS_YEARS)
+
+
+def get_stage_order(stages: dict) -> list:
+    """Orders the stages so that every stage comes after its dependencies.
+
+    Args:
+        stages (dict): Stage name -> (function, list of dependency names)
+
+    Raises:
+        ValueError: If a stage depends on an unknown stage or the dependencies form a cycle
+
+    Returns:
+        list: The stage names in a valid execution order
+    """
+    order = []
+    visiting = set()
+
+    def visit(name, path):
+        if name in order:
+            return
+        if name not in stages:
+            raise ValueError(
+                f"Stage {path[-1]} depends on unknown stage {name}")
+        if name in visiting:
+            raise ValueError(
+                f"Stage dependencies form a cycle: {' -> '.join(path + [name])}")
+        visiting.add(name)
+        for dependency in stages[name][1]:
+            visit(dependency, path + [name])
+        visiting.remove(name)
+        order.append(name)
+
+    for name in stages:
+        visit(name, [])
+    return order
+
+
+def run_pipeline_dag(stages: dict = None, max_workers: int = 4, executor: str = "thread") -> dict:
+    """Runs the pipeline stages on a worker pool, starting each stage as soon as
+    all of its dependencies have finished. A stage that raises marks every stage
+    downstream of it as skipped.
+
+    Args:
+        stages (dict, optional): Stage name -> (function, list of dependency names). Defaults to `PIPELINE_STAGES`.
+        max_workers (int, optional): Number of stages allowed to run at the same time. Defaults to 4.
+        executor (str, optional): "thread" or "process". Defaults to "thread".
+
+    Returns:
+        dict: Stage name -> "success", "failed" or "skipped"
+    """
+    stages = PIPELINE_STAGES if stages is None else stages
+    order = get_stage_order(stages)
+
+    if executor == "thread":
+        pool = ThreadPoolExecutor(max_workers=max_workers)
+    elif executor == "process":
+        pool = ProcessPoolExecutor(max_workers=max_workers)
+    else:
+        raise ValueError(f"Unknown executor {executor}")
+
+    status = {}
+    running = {}
+    with pool:
+        while len(status) < len(order):
+            for name in order:
+                if name in status or name in running.values():
+                    continue
+                dependencies = stages[name][1]
+                if any(status.get(d) in ("failed", "skipped") for d in dependencies):
+                    logger.error(
+                        f"Skipping stage {name}, an upstream stage did not finish")
+                    status[name] = "skipped"
+                elif all(status.get(d) == "success" for d in dependencies):
+                    logger.info(f"Starting stage {name}")
+                    running[pool.submit(stages[name][0])] = name
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    logger.success(f"Finished stage {name}")
+                    status[name] = "success"
+                except Exception as e:
+                    logger.error(f"Stage {name} failed: {e}")
+                    status[name] = "failed"
+
+    return status
@@ -0,0 +1,19 @@
+import geopandas as gpd
+from shapely.geometry import box
+
+from transform import iter_topojson_batches
+
+
+def test_iter_topojson_batches_ids_are_unique_across_batches():
+    zctas = gpd.GeoDataFrame({"zcta": ["00001", "00002"]},
+                             geometry=[box(0, 0, 1, 1), box(1, 0, 2, 1)], crs="EPSG:4269")
+    cbsa_zctas = [(f"{i:05}", f"CBSA {i}", zctas) for i in range(120)]
+
+    batches = list(iter_topojson_batches(cbsa_zctas, tolerance=0.005, batch_size=50))
+
+    assert [len(batch) for batch in batches] == [50, 50, 20]
+    # bulk_load_batches turns the index into the primary key
+    ids = [id for batch in batches for id in batch.index]
+    assert ids == list(range(120))
+    assert [cbsa_code for batch in batches for cbsa_code in batch["cbsa_code"]] == \
+        [cbsa_code for cbsa_code, _, _ in cbsa_zctas]
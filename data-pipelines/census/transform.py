@@ -1,29 +1,84 @@
 import json
 import re
+from itertools import islice
+from typing import Iterable, Iterator
 
+import geopandas as gpd
 import numpy as np
 import pandas as pd
 import requests
+import topojson
 
+from cache import cached_get
+
+
+# Annotation values the Census API returns in place of an estimate, see
+# https://www.census.gov/data/developers/data-sets/acs-1year/notes-on-acs-estimate-and-annotation-values.html
+CENSUS_NULL_CODES = [-111111111, -222222222, -333333333, -555555555,
+                     -666666666, -888888888, -999999999]
+
+GEOGRAPHY_COLUMNS = {
+    "zcta": {"zip code tabulation area": "zcta"},
+    "cbsa": {"metropolitan statistical area/micropolitan statistical area": "cbsa_code", "NAME": "cbsa"},
+}
+
+
+def parse_census_column(values: list, variable: str) -> pd.api.extensions.ExtensionArray:
+    """Converts the string values of one Census API variable into a typed column.
+    Annotation codes become missing values. Estimates that are whole numbers
+    become a nullable integer column, everything else a float column.
+
+    Args:
+        values (list): The raw values of the variable, one per geography
+        variable (str): The variable code, e.g. `DP04_0134E`
+
+    Returns:
+        pd.api.extensions.ExtensionArray: The typed column
+    """
+    column = np.fromiter((np.nan if value is None else float(value) for value in values),
+                         dtype=np.float64, count=len(values))
+    column[np.isin(column, CENSUS_NULL_CODES)] = np.nan
+
+    mask = np.isnan(column)
+    if not variable.endswith("PE") and np.array_equal(column[~mask], np.round(column[~mask])):
+        return pd.arrays.IntegerArray(np.where(mask, 0, column).astype(np.int64), mask)
+    return pd.arrays.FloatingArray(np.where(mask, 0, column), mask)
 
-def clean_census_data(response: requests.Response, geography="zcta") -> pd.DataFrame:
-    data = pd.DataFrame(json.loads(response.text))
-    # Set the 1st row as the header
-    data.columns = data.iloc[0]
-    data = data[1:]
-    # Remove the columns that are not needed
-    data = data.loc[:, ~data.columns.str.endswith(("EA", "MA", "M"))]
-    # Rename the geography column
-    if geography == "zcta":
-        data.rename(columns={"zip code tabulation area": "zcta"}, inplace=True)
-        data.drop(columns=["NAME"], inplace=True)
-    elif geography == "cbsa":
-        data.rename(columns={
-                    "metropolitan statistical area/micropolitan statistical area": "cbsa_code", "NAME": "cbsa"}, inplace=True)
-    # Replace NULL encoded values with NaN
-    data.replace(to_replace="-666666666", value=np.nan, inplace=True)
-    data.replace(to_replace="-666666666.0", value=np.nan, inplace=True)
-    return data
+
+def clean_census_data(rows, geography="zcta", variables: list = None) -> pd.DataFrame:
+    """Parses Census API data (a JSON list of rows whose first row is the
+    header) column by column into typed columns, without building an
+    intermediate frame of strings.
+
+    Args:
+        rows (list | requests.Response): The rows, or the Census API response holding them
+        geography (str, optional): "zcta" or "cbsa". Defaults to "zcta".
+        variables (list, optional): The variable codes to keep. Defaults to every estimate and percent estimate.
+
+    Returns:
+        pd.DataFrame: One row per geography with the geography columns and one typed column per variable
+    """
+    if isinstance(rows, requests.Response):
+        rows = json.loads(rows.text)
+    # The 1st row is the header
+    header, body = rows[0], rows[1:]
+    geography_columns = GEOGRAPHY_COLUMNS[geography]
+
+    if variables is None:
+        # Remove the columns that are not needed
+        variables = [column for column in header
+                     if column.startswith("DP") and not column.endswith(("EA", "MA", "M"))]
+
+    data = {}
+    for column, name in geography_columns.items():
+        index = header.index(column)
+        data[name] = [row[index] for row in body]
+    for variable in variables:
+        index = header.index(variable)
+        data[variable] = parse_census_column(
+            [row[index] for row in body], variable)
+
+    return pd.DataFrame(data)
 
 
 def standardize_column_name(column_name):
@@ -82,15 +137,89 @@ def truncate_column_names(df: pd.DataFrame) -> None:
     return df
 
 
+def get_variable_labels(variable_url: str) -> dict:
+    """Reads the label of every variable of a Census API dataset
+
+    Args:
+        variable_url (str): The dataset's `variables.json` URL
+
+    Returns:
+        dict: Variable code -> label
+    """
+    r = cached_get(variable_url)
+    variables = json.loads(r.text)["variables"]
+    return {variable: details["label"] for variable, details in variables.items()
+            if variable not in ["in", "for", "ucgid"]}
+
+
+def get_variable_codes(variable_url: str, columns: list, renames: dict = None) -> list:
+    """Finds the variable codes whose standardized labels are `columns`
+
+    Args:
+        variable_url (str): The dataset's `variables.json` URL
+        columns (list): Standardized column names, as produced by `get_human_readable_columns`
+        renames (dict, optional): Renames applied after standardizing the labels. Defaults to None.
+
+    Returns:
+        list: The matching variable codes
+    """
+    renames = renames or {}
+    codes = []
+    for variable, label in get_variable_labels(variable_url).items():
+        column = standardize_column_name(label)
+        if renames.get(column, column) in columns:
+            codes.append(variable)
+    return codes
+
+
 def get_human_readable_columns(variable_url: str, data: pd.DataFrame) -> pd.DataFrame:
     # Replace the column names with the human-readable names
-    r = requests.get(variable_url)
-    variable_names = pd.DataFrame(json.loads(r.text)["variables"]).T
-    variable_names.drop(index=["in", "for", "ucgid"], inplace=True)
-    variable_names.reset_index(inplace=True)
-    variable_names.rename(columns={"index": "variable"}, inplace=True)
-    data.rename(columns=variable_names.set_index(
-        "variable")["label"].to_dict(), inplace=True)
+    data.rename(columns=get_variable_labels(variable_url), inplace=True)
     # Clean up the column names
     data = truncate_column_names(data)
     return data
+
+
+def build_topojson(data: gpd.GeoDataFrame, object_name: str, tolerance: float, quantization: float = 1e5) -> str:
+    """Builds a TopoJSON topology from polygons that share boundaries. Every
+    shared boundary becomes a single arc, which is simplified once, so
+    neighbouring polygons stay gap and overlap free and each edge is only
+    stored once.
+
+    Args:
+        data (gpd.GeoDataFrame): The polygons, with their properties
+        object_name (str): The name of the polygons' object in the topology
+        tolerance (float): The simplification tolerance, in the units of the geometries
+        quantization (float, optional): Number of steps the coordinates are rounded to along each axis. Defaults to 1e5.
+
+    Returns:
+        str: The TopoJSON
+    """
+    topology = topojson.Topology(data, object_name=object_name, prequantize=False,
+                                 toposimplify=tolerance, topoquantize=quantization)
+    return topology.to_json()
+
+
+def iter_topojson_batches(cbsa_zctas: Iterable[tuple], tolerance: float, batch_size: int = 50) -> Iterator[pd.DataFrame]:
+    """Builds the TopoJSON of the ZCTAs of each CBSA, in batches of `batch_size` CBSAs
+
+    Args:
+        cbsa_zctas (Iterable[tuple]): The CBSA code, the CBSA name and a GeoDataFrame of its ZCTAs, per CBSA
+        tolerance (float): The simplification tolerance of the topologies
+        batch_size (int, optional): Number of CBSAs per batch. Defaults to 50.
+
+    Yields:
+        pd.DataFrame: One row per CBSA, indexed by its position across every batch so the ids loaded from the index are unique
+    """
+    cbsa_zctas = iter(cbsa_zctas)
+    offset = 0
+    while cbsas := list(islice(cbsa_zctas, batch_size)):
+        batch = pd.DataFrame({
+            "cbsa_code": [cbsa_code for cbsa_code, _, _ in cbsas],
+            "cbsa": [cbsa for _, cbsa, _ in cbsas],
+            "topojson": [build_topojson(zctas, object_name="zcta", tolerance=tolerance)
+                         for _, _, zctas in cbsas],
+        })
+        batch.index = pd.RangeIndex(offset, offset + len(batch))
+        offset += len(batch)
+        yield batch
@@ -1,7 +1,10 @@
-import pandas as pd
-from load import init_connection
+import json
+import os
+from typing import Iterator
+
+import geopandas as gpd
 from loguru import logger
-from sqlalchemy import exc, text
+from sqlalchemy import text
 
 
 def create_postgis_extension(conn):
@@ -26,39 +29,32 @@ def create_geospatial_schema(conn):
         logger.error(f"Error creating geospatial schema: {e}")
 
 
-def is_table_initialized(table_name: str) -> bool:
-    try:
-        conn = init_connection()
-        query = f"select id from {table_name} limit 1"
-        df = pd.read_sql(query, conn)
-        if df.empty:
-            logger.info(
-                f"Data for {table_name} not found in the DB, running data pipeline...")
-            conn.close()
-            return False
-        else:
-            logger.info(
-                f"Data for {table_name} already exists in the DB. Skipping data pipeline.")
-            conn.close()
-            return True
-
-    except exc.ProgrammingError as e:
-        # Handle the case where the table does not exist
-        logger.info(
-            f"Table {table_name} does not exist in the DB. Running data pipeline...")
-        conn.close()
-        return False
+# Geometry column -> simplification tolerance in degrees. The app reads the
+# coarsest column that is still below a pixel at the zoom it draws the map at.
+GEOMETRY_LEVELS_OF_DETAIL = {
+    "geometry": 0.001,
+    "geometry_medium": 0.005,
+    "geometry_coarse": 0.02,
+}
 
-    except Exception as e:
-        logger.error(f"Could not connect to database: {e}")
-        return False
+
+# The SRID of the TIGER/Line boundaries, NAD83
+BOUNDARY_SRID = 4269
+
+
+def get_simplified_geometry_columns(levels_of_detail: dict) -> str:
+    # Typed, so the SRID is registered for Find_SRID and the tile server
+    return ",\n            ".join(
+        f"ST_Multi(ST_SimplifyPreserveTopology(geometry, {tolerance}))::geometry(MultiPolygon, {BOUNDARY_SRID}) AS {column}"
+        for column, tolerance in levels_of_detail.items())
 
 
-def simplify_cbsa_polygons(conn, schema_name, tolerance=0.001):
-    """Creates a simplified version of the CBSA polygons using the Douglas-Peucker algorithm
+def simplify_cbsa_polygons(conn, schema_name, table_name, levels_of_detail=GEOMETRY_LEVELS_OF_DETAIL):
+    """Creates simplified versions of the CBSA polygons using the Douglas-Peucker algorithm, one column per level of detail
     """
+    geometry_columns = get_simplified_geometry_columns(levels_of_detail)
     query = f"""
-    create table if not exists {schema_name}.cbsa_boundaries_2021_simplified as (
+    create table if not exists {schema_name}.{table_name} as (
         select
             id,
             "CSAFP",
@@ -73,7 +69,7 @@ def simplify_cbsa_polygons(conn, schema_name, tolerance=0.001):
             "AWATER",
             "INTPTLAT",
             "INTPTLON",
-            ST_SimplifyPreserveTopology(geometry, {tolerance}) AS geometry
+            {geometry_columns}
         from {schema_name}.cbsa_boundaries_2021
         -- Exclude Puerto Rico
         where "NAMELSAD" not like '%%, PR%%'
@@ -84,16 +80,18 @@ def simplify_cbsa_polygons(conn, schema_name, tolerance=0.001):
     conn.commit()
 
     conn.execute(text(
-        f"create index on {schema_name}.cbsa_boundaries_2021_simplified using gist(geometry);"))
+        f"create index on {schema_name}.{table_name} using gist(geometry);"))
+    conn.execute(text(
+        f'create index on {schema_name}.{table_name} ("NAMELSAD");'))
     conn.commit()
-    conn.close()
 
 
-def simplify_zcta_polygons(conn, schema_name, tolerance=0.001):
-    """Creates a simplified version of the ZCTA polygons using the Douglas-Peucker algorithm
+def simplify_zcta_polygons(conn, schema_name, table_name, levels_of_detail=GEOMETRY_LEVELS_OF_DETAIL):
+    """Creates simplified versions of the ZCTA polygons using the Douglas-Peucker algorithm, one column per level of detail
     """
+    geometry_columns = get_simplified_geometry_columns(levels_of_detail)
     query = f"""
-        create table if not exists {schema_name}.zcta_boundaries_2021_simplified as (
+        create table if not exists {schema_name}.{table_name} as (
             select
                 id,
                 "ZCTA5CE20",
@@ -105,7 +103,7 @@ def simplify_zcta_polygons(conn, schema_name, tolerance=0.001):
                 "AWATER20",
                 "INTPTLAT20",
                 "INTPTLON20",
-                ST_SimplifyPreserveTopology(geometry, {tolerance}) AS geometry
+                {geometry_columns}
             from {schema_name}.zcta_boundaries_2021
         );
         """
@@ -114,18 +112,117 @@ def simplify_zcta_polygons(conn, schema_name, tolerance=0.001):
     conn.commit()
 
     conn.execute(text(
-        f"create index on {schema_name}.zcta_boundaries_2021_simplified using gist(geometry);"))
+        f"create index on {schema_name}.{table_name} using gist(geometry);"))
+    conn.execute(text(
+        f'create index on {schema_name}.{table_name} ("ZCTA5CE20");'))
     conn.commit()
-    conn.close()
 
 
-def create_simplified_polygons(conn, tolerance=0.001, geographic_granularity="CBSA"):
-    """Creates a simplified version of the polygons to use for mapping
+def create_simplified_polygons(conn, table_name, levels_of_detail=GEOMETRY_LEVELS_OF_DETAIL, geographic_granularity="CBSA"):
+    """Creates simplified versions of the polygons to use for mapping
     """
     if geographic_granularity == "CBSA":
         simplify_cbsa_polygons(
-            conn, schema_name="geospatial", tolerance=tolerance)
+            conn, schema_name="geospatial", table_name=table_name, levels_of_detail=levels_of_detail)
 
     elif geographic_granularity == "ZCTA":
         simplify_zcta_polygons(
-            conn, schema_name="geospatial", tolerance=tolerance)
+            conn, schema_name="geospatial", table_name=table_name, levels_of_detail=levels_of_detail)
+
+
+def create_zcta_cbsa_membership_table(conn, schema_name, table_name):
+    """Creates the table of which ZCTAs are in each CBSA, so drill-downs look them up by index instead of joining the crosswalk
+    """
+    query = f"""
+    create table if not exists {schema_name}.{table_name} as (
+        select distinct
+            zcta_boundaries_2021."ZCTA5CE20" as zcta
+            , cbsa_boundaries_2021_simplified."CBSAFP" as cbsa_code
+            , cbsa_boundaries_2021_simplified."NAMELSAD" as cbsa
+        from {schema_name}.zip_to_cbsa
+            inner join {schema_name}.zcta_boundaries_2021
+                on zcta_boundaries_2021."ZCTA5CE20" = zip_to_cbsa.zip_code
+            inner join {schema_name}.cbsa_boundaries_2021_simplified
+                on cbsa_boundaries_2021_simplified."CBSAFP" = zip_to_cbsa.cbsa_code
+    );
+    """
+
+    conn.execute(text(query))
+    conn.commit()
+
+    conn.execute(text(
+        f"alter table {schema_name}.{table_name} add primary key (cbsa_code, zcta);"))
+    conn.execute(text(
+        f"create index on {schema_name}.{table_name} (cbsa, zcta);"))
+    conn.execute(text(
+        f"create index on {schema_name}.{table_name} (zcta);"))
+    conn.commit()
+
+
+def iter_cbsa_zcta_boundaries(conn, schema_name="geospatial") -> Iterator[tuple]:
+    """Reads the full resolution ZCTA boundaries one CBSA at a time, so each
+    metro's topology can be built without holding every ZCTA in memory.
+
+    Yields:
+        tuple: The CBSA code, the CBSA name and a GeoDataFrame of its ZCTAs
+    """
+    cbsas = conn.execute(text(f"""
+    select distinct cbsa_code, cbsa
+    from {schema_name}.zcta_cbsa_membership
+    order by cbsa_code
+    """)).all()
+
+    for cbsa_code, cbsa in cbsas:
+        zctas = gpd.read_postgis(f"""
+        select
+            zcta_boundaries_2021."ZCTA5CE20" as zcta
+            , zcta_boundaries_2021.geometry
+        from {schema_name}.zcta_cbsa_membership
+            inner join {schema_name}.zcta_boundaries_2021
+                on zcta_boundaries_2021."ZCTA5CE20" = zcta_cbsa_membership.zcta
+        where zcta_cbsa_membership.cbsa_code = %(cbsa_code)s
+        """, con=conn, geom_col="geometry", params={"cbsa_code": cbsa_code})
+        if not zctas.empty:
+            yield cbsa_code, cbsa, zctas
+
+
+# The metrics shown in the app, defined once in the repository's `metrics.json`
+# with the ACS columns and the formula each is computed from
+METRICS_FILE = os.getenv("METRICS_FILE",
+                         os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "metrics.json"))
+
+
+def load_metrics() -> dict:
+    with open(METRICS_FILE) as f:
+        return json.load(f)
+
+
+ACS_METRICS = load_metrics()
+
+# Metric -> the SQL computing it from the ACS columns of each geography
+ACS_DISPLAY_METRICS = {metric: config["formula"] for metric, config in ACS_METRICS.items()}
+
+
+def create_acs_metrics_table(conn, schema_name, table_name, geography="cbsa", year=2021):
+    """Creates a narrow table with only the display metrics of a geography and year, so the app doesn't compute them on every query
+    """
+    metrics = ",\n            ".join(
+        f"{expression} as {metric}" for metric, expression in ACS_DISPLAY_METRICS.items())
+    query = f"""
+    create table if not exists {schema_name}.{table_name} as (
+        select
+            id,
+            year,
+            {geography},
+            {metrics}
+        from {schema_name}.acs_census_{geography}
+        where year = {year}
+    );
+    """
+
+    conn.execute(text(query))
+    conn.commit()
+
+    conn.execute(text(
+        f"create index on {schema_name}.{table_name} ({geography});"))
+    conn.commit()
@@ -1,6 +1,8 @@
 import pandas as pd
 import streamlit as st
 
+from metrics import get_metric_format
+
 
 def display_dataframe(data: pd.DataFrame, metric_internal_name: str, metric_display_name: str, geographic_granularity_internal_name: str, geographic_granularity_display_name: str):
 
@@ -15,11 +17,13 @@ def display_dataframe(data: pd.DataFrame, metric_internal_name: str, metric_disp
             label=geographic_granularity_display_name
         ),
         metric_internal_name: st.column_config.NumberColumn(
-            label=metric_display_name
+            label=metric_display_name,
+            format=get_metric_format(metric_internal_name)
         )
     }
 
     # Drop geometry column if it exists
+    new_df = data
     if "geometry" in data.columns:
         new_df = data.drop(columns=["geometry"])
     if "geom" in data.columns:
@@ -0,0 +1,130 @@
+from typing import Literal
+
+import branca
+import numpy as np
+from branca.element import MacroElement
+from jinja2 import Template
+
+# How values are grouped into colors
+COLOR_SCHEMES = ("linear", "quantile", "natural_breaks")
+
+
+def get_natural_breaks(values: np.ndarray, k: int, max_values: int = 1000) -> np.ndarray:
+    """Jenks natural breaks: the class bounds minimizing the squared deviation of each class from its mean
+
+    Args:
+        values (np.ndarray): The values to classify, without missing values
+        k (int): The number of classes
+        max_values (int, optional): Larger inputs are reduced to this many of their quantiles first, as the cost is quadratic
+
+    Returns:
+        np.ndarray: The sorted bounds of the classes, from the smallest to the largest value
+    """
+    values = np.sort(values)
+    if len(values) > max_values:
+        values = np.quantile(values, np.linspace(0, 1, max_values))
+    n = len(values)
+    k = min(k, n)
+
+    # The squared deviation of values[start:end] for every start and end, from cumulative sums
+    sums = np.concatenate([[0], np.cumsum(values)])
+    squares = np.concatenate([[0], np.cumsum(values ** 2)])
+    starts = np.arange(n + 1)[:, None]
+    ends = np.arange(n + 1)[None, :]
+    counts = ends - starts
+    with np.errstate(divide="ignore", invalid="ignore"):
+        deviation = squares[ends] - squares[starts] - \
+            (sums[ends] - sums[starts]) ** 2 / counts
+    deviation[counts <= 0] = np.inf
+
+    # cost[c, end] is the least deviation of values[:end] split into c classes,
+    # the last of them starting at split[c, end]
+    cost = np.full((k + 1, n + 1), np.inf)
+    cost[0, 0] = 0
+    split = np.zeros((k + 1, n + 1), dtype=int)
+    for c in range(1, k + 1):
+        candidates = cost[c - 1][:, None] + deviation
+        split[c] = np.argmin(candidates, axis=0)
+        cost[c] = candidates[split[c], np.arange(n + 1)]
+
+    lower_bounds = []
+    end = n
+    for c in range(k, 0, -1):
+        end = split[c, end]
+        lower_bounds.append(values[end])
+    return np.unique(lower_bounds + [values[-1]])
+
+
+def get_class_breaks(values: np.ndarray, scheme: Literal["quantile", "natural_breaks"], k: int) -> np.ndarray:
+    """The sorted bounds of `k` classes of `values`, fewer if some of them would be
+    empty, and none if every value is missing
+    """
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return np.array([])
+    if scheme == "quantile":
+        return np.unique(np.quantile(values, np.linspace(0, 1, k + 1)))
+    if scheme == "natural_breaks":
+        return get_natural_breaks(values, k)
+    raise ValueError(f"Unknown color scheme {scheme}")
+
+
+def get_fill_colors(values: np.ndarray, colormap: branca.colormap.ColorMap, steps: int = 256) -> np.ndarray:
+    """Colors every value with `colormap` at once, instead of calling it once per value
+
+    A linear colormap is sampled into `steps` colors, which is finer than can be told apart.
+
+    Args:
+        values (np.ndarray): The values to color
+        colormap (branca.colormap.ColorMap): A linear or step colormap
+        steps (int, optional): How many colors to sample a linear colormap into
+
+    Returns:
+        np.ndarray: The hex color of each value, None for missing values
+    """
+    values = np.asarray(values, dtype=float)
+    if isinstance(colormap, branca.colormap.StepColormap):
+        edges = np.asarray(colormap.index, dtype=float)
+    else:
+        edges = np.linspace(colormap.vmin, colormap.vmax, steps + 1)
+    # A colormap of no values has no range to color
+    if not np.isfinite(edges).all():
+        return np.full(len(values), None, dtype=object)
+    # The color of each class is looked up once
+    palette = np.array([colormap.rgb_hex_str((low + high) / 2)
+                        for low, high in zip(edges[:-1], edges[1:])], dtype=object)
+
+    classes = np.clip(np.searchsorted(edges, values, side="right") - 1,
+                      0, len(palette) - 1)
+    colors = palette[classes]
+    colors[np.isnan(values)] = None
+    return colors
+
+
+class FeatureColorStyle(MacroElement):
+    """Styles the features of its parent GeoJson or TopoJson layer in the
+    browser, filling each with the color in its `property`. Unlike a
+    `style_function`, this doesn't call back into Python or embed a style per feature.
+    """
+
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            {{ this._parent.get_name() }}.options.style = function(feature) {
+                return {
+                    "fillColor": feature.properties[{{ this.property|tojson }}] || "transparent",
+                    "color": {{ this.line_color|tojson }},
+                    "fillOpacity": {{ this.fill_opacity|tojson }}
+                };
+            };
+            {{ this._parent.get_name() }}.setStyle({{ this._parent.get_name() }}.options.style);
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, property: str = "fill_color", line_color: str = "black", fill_opacity: float = 1):
+        super().__init__()
+        self._name = "FeatureColorStyle"
+        self.property = property
+        self.line_color = line_color
+        self.fill_opacity = fill_opacity
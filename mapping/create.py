@@ -1,17 +1,26 @@
+import os
 from typing import Literal
 
 import branca
 import folium
 import geopandas as gpd
+import numpy as np
+import pandas as pd
 import pydeck as pdk
 import streamlit as st
 from folium.plugins import Geocoder
 from streamlit_folium import st_folium
 
+from mapping.colors import (FeatureColorStyle, get_class_breaks,
+                            get_fill_colors)
+from mapping.serialize import (CompactDeck, compact_geodataframe,
+                               get_polygon_rings, to_compact_geojson)
+from metrics import get_metric
+from queries.boundaries import DRILL_DOWN_ZOOM, NATIONAL_ZOOM
 from utils import title_case_columns
 
 
-def create_colormap(data: gpd.GeoDataFrame, target_column: str, colormap_caption: str, colormap_colors: list = ['#ffffff', '#f9e3e3', '#f4c6c6', '#eeaaaa', '#e88e8e', '#e27272', '#dd5555', '#d73939']) -> branca.colormap.LinearColormap:
+def create_colormap(data: gpd.GeoDataFrame, target_column: str, colormap_caption: str, colormap_colors: list = ['#ffffff', '#f9e3e3', '#f4c6c6', '#eeaaaa', '#e88e8e', '#e27272', '#dd5555', '#d73939'], scheme: Literal["linear", "quantile", "natural_breaks"] = "linear", k: int = None) -> branca.colormap.ColorMap:
     """Create a colormap for a choropleth map.
 
     Args:
@@ -23,8 +32,12 @@ def create_colormap(data: gpd.GeoDataFrame, target_column: str, colormap_caption
 
         colormap_caption (str): The caption for the colormap to be shown on the map legend.
 
+        scheme (str): How values are grouped into colors. `linear` scales them continuously, `quantile` and `natural_breaks` into `k` classes.
+
+        k (int): The number of classes of the `quantile` and `natural_breaks` schemes, one per color by default.
+
     Returns:
-        branca.colormap.LinearColormap: A colormap to be used in a choropleth map.
+        branca.colormap.ColorMap: A colormap to be used in a choropleth map, linear or stepped depending on `scheme`.
     """
 
     # Define the colormap
@@ -34,6 +47,13 @@ def create_colormap(data: gpd.GeoDataFrame, target_column: str, colormap_caption
         vmax=data[target_column].quantile(1),
         caption=colormap_caption
     )
+    if scheme != "linear":
+        breaks = get_class_breaks(data[target_column].to_numpy(dtype=float), scheme,
+                                  k=len(colormap_colors) if k is None else k)
+        # With fewer than two classes there is nothing to step between
+        if len(breaks) > 2:
+            colormap = colormap.to_step(index=breaks)
+            colormap.caption = colormap_caption
     return colormap
 
 
@@ -49,23 +69,56 @@ def add_map_plugins(m):
     return m
 
 
-def create_choropleth(data: gpd.GeoDataFrame, target_column: str, height: int = 500, aliases: list = None, colormap_caption: str = None, cbsa_internal_points: list = None) -> dict:
+def add_feature_properties(features: list, data: pd.DataFrame, on_column: str) -> list:
+    """Replaces the properties of GeoJSON features or TopoJSON geometries with the matching row of `data`. Features without data are dropped.
+
+    Args:
+        features (list): Features with an `on_column` property
+        data (pd.DataFrame): The data to map, without geometry
+        on_column (str): The column identifying each feature
+
+    Returns:
+        list: The features with data, with their properties replaced
+    """
+    # None rather than NaN, so missing values serialize to valid JSON
+    records = data.astype(object).where(data.notna(), None).set_index(
+        on_column, drop=False).to_dict("index")
+    matched_features = []
+    for feature in features:
+        record = records.get(feature["properties"][on_column])
+        if record is not None:
+            feature["properties"] = record
+            matched_features.append(feature)
+    return matched_features
+
+
+def create_choropleth(data: gpd.GeoDataFrame, target_column: str, height: int = 500, aliases: list = None, colormap_caption: str = None, cbsa_internal_points: list = None, topology: dict = None, geojson: dict = None, on_column: str = None, center: list = None, zoom: float = None, scale_data: pd.DataFrame = None, track_view: bool = False, fit_bounds: tuple = None) -> dict:
 
     # Create the folium map
-    if cbsa_internal_points is None:
-        m = folium.Map(location=[35.3, -97.6], zoom_start=4,
+    if center is not None:
+        m = folium.Map(location=center, zoom_start=zoom,
+                       tiles='CartoDB positron', scrollWheelZoom=True)
+    elif cbsa_internal_points is None:
+        m = folium.Map(location=[35.3, -97.6], zoom_start=NATIONAL_ZOOM,
                        tiles='CartoDB positron', scrollWheelZoom=True)
     else:
-        m = folium.Map(location=cbsa_internal_points, zoom_start=7,
+        m = folium.Map(location=cbsa_internal_points, zoom_start=DRILL_DOWN_ZOOM,
                        tiles='CartoDB positron', scrollWheelZoom=True)
+        # Scope the drill down to its CBSA, unless the user has moved it since
+        if fit_bounds is not None:
+            west, south, east, north = fit_bounds
+            m.fit_bounds([[south, west], [north, east]])
 
-    # Define the colormap
-    colormap = create_colormap(data=data,
+    # Define the colormap, over the whole layer when only the part in view is drawn
+    colormap = create_colormap(data=data if scale_data is None else scale_data,
                                colormap_caption=colormap_caption,
-                               target_column=target_column)
+                               target_column=target_column,
+                               colormap_colors=get_metric(target_column)["colors"],
+                               scheme=get_metric(target_column)["scheme"])
 
     # Non geometry columns
-    non_geometry_columns = data.drop(columns=["geometry"]).columns.to_list()
+    non_geometry_columns = [
+        column for column in data.columns if column != "geometry"]
 
     # Create popups
     popup = folium.GeoJsonPopup(
@@ -93,20 +146,36 @@ def create_choropleth(data: gpd.GeoDataFrame, target_column: str, height: int =
         """
     )
 
-    # Create the GeoJson
-    g = folium.GeoJson(
-        data,
-        style_function=lambda x: {
-            "fillColor": colormap(x["properties"][target_column])
-            if x["properties"][target_column] is not None
-            else "transparent",
-            "color": "black",
-            "fillOpacity": 1,
-        },
-        tooltip=tooltip,
-        popup=popup,
-        name="Toggle Choropleth"
-    )
+    # Color every feature at once, the browser then fills each with its `fill_color`
+    data = data.assign(fill_color=get_fill_colors(
+        data[target_column].to_numpy(dtype=float), colormap))
+    styled_columns = non_geometry_columns + ["fill_color"]
+
+    if topology is None:
+        if geojson is not None:
+            # Pre-serialized boundaries only need the data added to them
+            geojson["features"] = add_feature_properties(
+                geojson["features"], data[styled_columns], on_column=on_column)
+
+        # Create the GeoJson
+        g = folium.GeoJson(
+            to_compact_geojson(data, styled_columns) if geojson is None else geojson,
+            tooltip=tooltip,
+            popup=popup,
+            name="Toggle Choropleth"
+        )
+    else:
+        # Shared boundaries are sent once as TopoJSON arcs instead of once per polygon
+        geometries = topology["objects"][on_column]["geometries"]
+        topology["objects"][on_column]["geometries"] = add_feature_properties(
+            geometries, data[styled_columns], on_column=on_column)
+        g = folium.TopoJson(
+            topology,
+            object_path=f"objects.{on_column}",
+            tooltip=tooltip,
+            name="Toggle Choropleth"
+        )
+    FeatureColorStyle(property="fill_color").add_to(g)
 
     # Add the GeoJson to the map
     g.add_to(m)
@@ -117,33 +186,54 @@ def create_choropleth(data: gpd.GeoDataFrame, target_column: str, height: int =
     # Add plugins to the map
     add_map_plugins(m)
 
+    # Clicks are returned as coordinates, maps drawing only the boundaries in view also report where they are moved to
+    returned_objects = ["last_object_clicked"]
+    if track_view:
+        returned_objects += ["bounds", "center", "zoom"]
     map = st_folium(m, use_container_width=True,
-                    height=height, returned_objects=["last_object_clicked_tooltip"])
+                    height=height, returned_objects=returned_objects)
 
     return map
 
 
 def create_3d_map(data: gpd.GeoDataFrame, target_column: str, target_display_name: str, geographic_granularity: Literal["cbsa", "zcta"] = "cbsa") -> None:
-    # Get the min and max values for setting elevation and fill color
-    min_value = data[target_column].min()
-    max_value = data[target_column].max()
-
-    # Normalize to a range between 0 and 1
-    normalized_elevation = f"({target_column} - {min_value}) / ({max_value - min_value})"
-    elevation = f"200000 * {normalized_elevation}"
-    fill_color_scaler = f"{normalized_elevation}"
-
-    # Create GeoJsonLayer using Pydeck
-    geojson_layer = pdk.Layer(
-        "GeoJsonLayer",
-        data=data,
+    data = compact_geodataframe(data, [geographic_granularity, target_column])
+
+    # Normalize to a range between 0 and 1, for setting elevation and fill color
+    values = data[target_column].to_numpy(dtype=float)
+    min_value = np.nanmin(values) if len(values) else 0
+    value_range = np.nanmax(values) - min_value if len(values) else 0
+    normalized = (values - min_value) / \
+        value_range if value_range else np.zeros_like(values)
+
+    # Computed here once instead of by deck.gl evaluating an expression for every feature
+    elevation = 200000 * normalized
+    fill_color = np.column_stack([np.full_like(normalized, 255),
+                                  255 - normalized * 255,
+                                  255 - normalized * 255]).round().astype(np.uint8)
+
+    # Polygons are sent as rings of coordinates, one row per part of a multipolygon
+    polygons, positions = get_polygon_rings(np.asarray(data.geometry.array))
+    layer_data = pd.DataFrame({
+        geographic_granularity: data[geographic_granularity].to_numpy()[positions],
+        target_column: values[positions],
+        "polygon": polygons,
+        "elevation": elevation[positions],
+        "fill_color": fill_color[positions].tolist(),
+    })
+
+    # Create PolygonLayer using Pydeck
+    polygon_layer = pdk.Layer(
+        "PolygonLayer",
+        data=layer_data,
         opacity=1,
         stroked=True,
         filled=True,
         extruded=True,
         wireframe=True,
-        get_elevation=elevation,
-        get_fill_color=f"[255, 255 - {fill_color_scaler} * 255, 255 - {fill_color_scaler} * 255]",
+        get_polygon="polygon",
+        get_elevation="elevation",
+        get_fill_color="fill_color",
         get_line_color=[255, 255, 255],
         pickable=True
     )
@@ -152,13 +242,13 @@ def create_3d_map(data: gpd.GeoDataFrame, target_column: str, target_display_nam
     view_state = pdk.ViewState(
         latitude=35.3,
         longitude=-97.6,
-        zoom=4,
+        zoom=NATIONAL_ZOOM,
         pitch=45
     )
     # Create the Pydeck Deck
-    r = pdk.Deck(layers=[geojson_layer],
-                 initial_view_state=view_state,
-                 tooltip={
+    r = CompactDeck(layers=[polygon_layer],
+                    initial_view_state=view_state,
+                    tooltip={
         "html": f"<b>{geographic_granularity.upper()}: {{{geographic_granularity}}}</b><br/><b>{target_display_name}</b> {{{target_column}}}",
         "style": {
             "backgroundColor": "steelblue",
@@ -170,3 +260,64 @@ def create_3d_map(data: gpd.GeoDataFrame, target_column: str, target_display_nam
 
     # Render the map in Streamlit
     return st.pydeck_chart(r)
+
+
+def get_tile_url(layer: Literal["cbsa", "zcta"], target_column: str, year: int) -> str:
+    """The URL template of the vector tiles of `layer`, or None if no tile server is configured
+
+    The URL is fetched by the browser, so `TILE_SERVER_URL` must be reachable from it.
+    """
+    tile_server_url = os.getenv("TILE_SERVER_URL")
+    if not tile_server_url:
+        return None
+    return f"{tile_server_url.rstrip('/')}/{layer}/{{z}}/{{x}}/{{y}}.mvt?metric={target_column}&year={year}"
+
+
+def create_3d_tile_map(layer: Literal["cbsa", "zcta"], target_column: str, target_display_name: str, year: int, min_value: float, max_value: float) -> None:
+    """Like `create_3d_map`, but draws `layer` from the tile server with an MVTLayer, so only the tiles in view are downloaded
+    """
+    # Normalized by deck.gl for every feature, to a range between 0 and 1. Without a
+    # range to normalize by, e.g. a single geography, every feature is flat and white.
+    value_range = max_value - min_value if min_value is not None and max_value is not None else 0
+    if value_range and np.isfinite(value_range):
+        normalized_elevation = f"(properties.{target_column} - {min_value}) / ({value_range})"
+    else:
+        normalized_elevation = "0"
+    elevation = f"200000 * {normalized_elevation}"
+
+    mvt_layer = pdk.Layer(
+        "MVTLayer",
+        data=get_tile_url(layer, target_column, year),
+        min_zoom=0,
+        max_zoom=14,
+        opacity=1,
+        stroked=True,
+        filled=True,
+        extruded=True,
+        wireframe=True,
+        get_elevation=elevation,
+        get_fill_color=f"[255, 255 - {normalized_elevation} * 255, 255 - {normalized_elevation} * 255]",
+        get_line_color=[255, 255, 255],
+        pickable=True
+    )
+
+    view_state = pdk.ViewState(
+        latitude=35.3,
+        longitude=-97.6,
+        zoom=NATIONAL_ZOOM,
+        pitch=45
+    )
+    r = CompactDeck(layers=[mvt_layer],
+                    initial_view_state=view_state,
+                    tooltip={
+        "html": f"<b>{layer.upper()}: {{{layer}}}</b><br/><b>{target_display_name}</b> {{{target_column}}}",
+        "style": {
+            "backgroundColor": "steelblue",
+            "color": "white"
+        }
+    },
+        map_style="light"
+    )
+
+    return st.pydeck_chart(r)
+
@@ -0,0 +1,78 @@
+import json
+
+import geopandas as gpd
+import numpy as np
+import pydeck as pdk
+import shapely
+from pydeck.bindings.json_tools import default_serialize
+
+# Decimal places of longitude and latitude kept in map payloads, about a meter
+GEOJSON_PRECISION = 5
+
+
+def compact_geodataframe(data: gpd.GeoDataFrame, columns: list, precision: int = GEOJSON_PRECISION) -> gpd.GeoDataFrame:
+    """Prepares boundaries to be sent to the browser: keeps only `columns`, rounds
+    coordinates to `precision` decimal places and drops the vertices that become
+    duplicate or collinear, which don't change the drawn shape.
+
+    Args:
+        data (gpd.GeoDataFrame): The data to map
+        columns (list): The columns shown or used by the map, besides the geometry
+        precision (int, optional): Decimal places of the coordinates to keep
+
+    Returns:
+        gpd.GeoDataFrame: A new GeoDataFrame in EPSG:4326, without rows whose geometry collapsed
+    """
+    if data.crs is not None and not data.crs.equals("EPSG:4326"):
+        data = data.to_crs("EPSG:4326")
+    geometries = shapely.transform(np.asarray(data.geometry.array),
+                                   lambda coordinates: np.round(coordinates, precision))
+    # With no tolerance only points lying on the line between their neighbors are removed
+    geometries = shapely.simplify(geometries, 0)
+
+    compact = gpd.GeoDataFrame(data[columns], geometry=geometries, crs=data.crs)
+    return compact[~compact.geometry.is_empty]
+
+
+def to_compact_geojson(data: gpd.GeoDataFrame, columns: list, precision: int = GEOJSON_PRECISION) -> dict:
+    """Like `compact_geodataframe`, as a FeatureCollection without the ids and
+    bounding boxes `__geo_interface__` adds to every feature
+    """
+    compact = compact_geodataframe(data, columns, precision)
+    return {
+        "type": "FeatureCollection",
+        "features": list(compact.iterfeatures(na="null", show_bbox=False, drop_id=True)),
+    }
+
+
+def get_polygon_rings(geometries: np.ndarray) -> tuple:
+    """Flattens polygons and multipolygons into the lists of rings deck.gl's
+    PolygonLayer draws, one per polygon, so it doesn't have to parse GeoJSON
+
+    Args:
+        geometries (np.ndarray): An array of shapely polygons and multipolygons
+
+    Returns:
+        tuple: The polygons, each a list of rings of [longitude, latitude] pairs with
+            the exterior first, and the position in `geometries` each polygon came from
+    """
+    parts, part_index = shapely.get_parts(geometries, return_index=True)
+    rings, ring_index = shapely.get_rings(parts, return_index=True)
+    coordinates, coordinate_index = shapely.get_coordinates(
+        rings, return_index=True)
+
+    # Split the coordinates where each ring starts, then group the rings of each polygon
+    ring_coordinates = np.split(
+        coordinates, np.flatnonzero(np.diff(coordinate_index)) + 1)
+    polygons = [[] for _ in range(len(parts))]
+    for ring, polygon in zip(ring_coordinates, ring_index):
+        polygons[polygon].append(ring.tolist())
+    return polygons, part_index
+
+
+class CompactDeck(pdk.Deck):
+    """A pydeck Deck whose JSON, which Streamlit sends as is, has no indentation
+    """
+
+    def to_json(self):
+        return json.dumps(self, default=default_serialize, separators=(",", ":"))
@@ -1,20 +1,77 @@
-from queries.boundaries import load_cbsa_geom_data, load_zcta_geom
-from queries.data import load_cbsa_acs_data, load_zcta_acs_data
+import streamlit as st
+
+from queries.boundaries import (get_geometry_column, load_cbsa_geojson,
+                                load_zcta_geojson, load_zcta_topojson)
+from queries.maps import load_cbsa_map_data, load_zcta_map_data
 
 
 def get_geographic_mapping(geographic_granularity):
     granularity_mapping = {
         "CBSA": {
-            "geom_function": load_cbsa_geom_data,
-            "data_function": load_cbsa_acs_data,
+            "map_function": load_cbsa_map_data,
+            "geojson_function": load_cbsa_geojson,
             "on_column": "cbsa",
         },
         "ZCTA": {
-            "geom_function": load_zcta_geom,
-            "data_function": load_zcta_acs_data,
+            "map_function": load_zcta_map_data,
+            "geojson_function": load_zcta_geojson,
+            "topology_function": load_zcta_topojson,
             "on_column": "zcta",
         },
         # Add more mappings as needed
     }
 
     return granularity_mapping.get(geographic_granularity, None)
+
+
+def load_granularity_map(granularity_info: dict, metric: str, year: int, base_year: int = None, **kwargs):
+    """Loads only `metric` of `year`, or its change since `base_year`, joined to
+    the boundaries and without missing values in a single query
+    """
+    return granularity_info["map_function"](metric=metric, year=year, base_year=base_year, **kwargs)
+
+
+def get_map_view(key: str) -> dict:
+    """The view the map `key` was last drawn for, with the `bounds` its boundaries
+    were loaded for, its `center` and its `zoom`. Empty until the map is first moved.
+    """
+    return st.session_state.get(key, {})
+
+
+def update_map_view(key: str, map_state: dict, padding: float = 0.5) -> bool:
+    """Records where the user moved the map `key` to, if it is out of the bounds
+    its boundaries were loaded for or needs another level of detail. The bounds
+    are padded by `padding` times their size on each side, so small pans don't
+    load boundaries again.
+
+    Args:
+        key (str): The name of the map
+        map_state (dict): What `st_folium` returned for the map, with `bounds`, `center` and `zoom`
+        padding (float, optional): How much bigger than the view to load boundaries for
+
+    Returns:
+        bool: True if the boundaries in view have to be loaded again
+    """
+    # Until the map has been drawn, st_folium only returns the bounds of its data
+    map_state = map_state or {}
+    bounds = map_state.get("bounds")
+    if not bounds or bounds["_southWest"]["lng"] is None or not map_state.get("center"):
+        return False
+    west, south = bounds["_southWest"]["lng"], bounds["_southWest"]["lat"]
+    east, north = bounds["_northEast"]["lng"], bounds["_northEast"]["lat"]
+    zoom = map_state["zoom"]
+
+    view = get_map_view(key)
+    if view and get_geometry_column(zoom) == get_geometry_column(view["zoom"]):
+        loaded_west, loaded_south, loaded_east, loaded_north = view["bounds"]
+        if loaded_west <= west and loaded_south <= south and loaded_east >= east and loaded_north >= north:
+            return False
+
+    width, height = east - west, north - south
+    st.session_state[key] = {
+        "bounds": (west - width * padding, south - height * padding,
+                   east + width * padding, north + height * padding),
+        "center": [map_state["center"]["lat"], map_state["center"]["lng"]],
+        "zoom": zoom,
+    }
+    return True
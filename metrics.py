@@ -0,0 +1,57 @@
+import json
+import os
+
+# Colors of the map scales, from the smallest to the largest value
+RED_SCALE = ['#ffffff', '#f9e3e3', '#f4c6c6', '#eeaaaa',
+             '#e88e8e', '#e27272', '#dd5555', '#d73939']
+
+# The metrics shared by the app, the pipeline and the tile server, defined once in
+# `metrics.json`: internal name -> display name, the ACS columns and SQL formula
+# the pipeline computes it from, its unit and its color scheme, one of
+# `mapping.colors.COLOR_SCHEMES`
+METRICS_FILE = os.getenv("METRICS_FILE",
+                         os.path.join(os.path.dirname(os.path.abspath(__file__)), "metrics.json"))
+
+
+def load_metrics() -> dict:
+    with open(METRICS_FILE) as f:
+        metrics = json.load(f)
+    return {metric: {"colors": RED_SCALE, **config} for metric, config in metrics.items()}
+
+
+METRICS = load_metrics()
+
+# How values of each unit are formatted in tables
+UNIT_FORMATS = {
+    "$": "$%d",
+    "%": "%.1f%%",
+}
+
+
+def get_metric(metric: str) -> dict:
+    """The registry entry of `metric`
+
+    Raises:
+        ValueError: If `metric` is not in the registry. Metric names are put into SQL, so they must be checked with this first.
+    """
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric {metric}")
+    return METRICS[metric]
+
+
+def get_metric_display_names() -> list:
+    return [config["display_name"] for config in METRICS.values()]
+
+
+def get_metric_expression(metric: str, table: str) -> str:
+    """The column of `table`, a metrics table or its alias, holding `metric`. The
+    pipeline computes every metric from its formula into a column of the same name.
+    """
+    get_metric(metric)
+    return f"{table}.{metric}"
+
+
+def get_metric_format(metric: str) -> str:
+    """The printf-style format of the values of `metric`, or None to leave them as they are
+    """
+    return UNIT_FORMATS.get(get_metric(metric)["unit"])
@@ -1,16 +1,19 @@
 import os
 
-import pandas as pd
 import streamlit as st
 from dotenv import load_dotenv
 from streamlit_extras.app_logo import add_logo
 
 from display import display_dataframe
 from mapping.create import create_choropleth
-from mapping.utils import get_geographic_mapping
-from queries.boundaries import get_cbsa_center_point
+from mapping.utils import (get_geographic_mapping, get_map_view,
+                           load_granularity_map, update_map_view)
+from queries.boundaries import (DRILL_DOWN_ZOOM, NATIONAL_ZOOM,
+                                get_artifact_version, locate_cbsa)
+from queries.prefetch import get_drill_down_prefetcher
 from sidebar import init_sidebar
-from utils import get_metric_internal_name, reduce_top_margin
+from utils import (get_metric_internal_name, load_concurrently,
+                   reduce_top_margin)
 
 st.set_page_config(
     page_title="Heat Maps",
@@ -45,89 +48,137 @@ def app():
     
     - Search for a specific location's on the map using the search bar in the bottom right corner.
 
-    **Data Source (2021):**
+    **Data Source:**
     
-    The maps are based on the [Selected Housing Characteristics dataset (2021)](https://data.census.gov/table/ACSDP5Y2021.DP04) from the American Community Survey, compiled by the [Census Bureau](https://www.census.gov/).
+    The maps are based on the [Selected Housing Characteristics dataset](https://data.census.gov/table/ACSDP5Y2021.DP04) from the American Community Survey 5-year estimates, compiled by the [Census Bureau](https://www.census.gov/).
     """
     )
 
     # Initalize the sidebar
-    metric_display_name = init_sidebar()
+    metric_display_name, year, base_year = init_sidebar()
     metric_internal_name = get_metric_internal_name(metric_display_name)
+    if base_year is not None:
+        metric_display_name = f"Change in {metric_display_name} since {base_year}"
+
+    # Warm the drill downs of the recently clicked CBSAs for the selected metric and year
+    prefetcher = get_drill_down_prefetcher()
+    prefetcher.follow(metric_internal_name, year, base_year)
+
+    # The boundary files published by the pipeline, the same for the whole run
+    artifact_version = get_artifact_version()
 
     geographic_granularity = "CBSA"
     # Get mapping information
     granularity_info = get_geographic_mapping(geographic_granularity)
     if granularity_info:
-        geom_boundaries = granularity_info["geom_function"]()
-        data = granularity_info["data_function"]()
         geographic_granularity_internal_name = granularity_info["on_column"]
-
-        # Clean the data
-        data[metric_internal_name] = pd.to_numeric(
-            data[metric_internal_name], errors="coerce")
-        data = geom_boundaries.merge(
-            data, on=granularity_info["on_column"], how="inner")
-        data = data[[geographic_granularity_internal_name,
-                     metric_internal_name, "geometry"]]
-        data.dropna(inplace=True)
+        # The GeoJSON and the selected metric don't depend on each other, so they are loaded together
+        loaded = load_concurrently(
+            geojson=lambda: granularity_info["geojson_function"](version=artifact_version),
+            layer_data=lambda: load_granularity_map(granularity_info, metric_internal_name, year, base_year,
+                                                    with_geometry=False))
+        # Prefer the pre-serialized GeoJSON published by the pipeline
+        geojson = loaded["geojson"]
+        # The colors and the table cover every CBSA, not only those drawn
+        layer_data = loaded["layer_data"]
+        # Without the GeoJSON, only the boundaries around where the map was last moved to are drawn
+        view = get_map_view("cbsa_map_view") if geojson is None else {}
+        data = layer_data if geojson is not None else load_granularity_map(
+            granularity_info, metric_internal_name, year, base_year,
+            zoom=view.get("zoom", NATIONAL_ZOOM), bounds=view.get("bounds"))
 
         with st.spinner("Loading map..."):
             # Create the choropleth
-            last_object_clicked_tooltip = create_choropleth(data=data,
-                                                            target_column=metric_internal_name,
-                                                            height=600,
-                                                            aliases=[geographic_granularity,
-                                                                     metric_display_name],
-                                                            colormap_caption=metric_display_name,
-                                                            cbsa_internal_points=None)
-            if last_object_clicked_tooltip["last_object_clicked_tooltip"] is not None:
-                cbsa_name = last_object_clicked_tooltip["last_object_clicked_tooltip"]
-                cbsa_name = cbsa_name.split("Area")[0].split("CBSA")[
-                    1] + "Area"
-                cbsa_name = cbsa_name.strip()
+            map_state = create_choropleth(data=data,
+                                          target_column=metric_internal_name,
+                                          height=600,
+                                          aliases=[geographic_granularity,
+                                                   metric_display_name],
+                                          colormap_caption=metric_display_name,
+                                          cbsa_internal_points=None,
+                                          geojson=geojson,
+                                          on_column=geographic_granularity_internal_name,
+                                          center=view.get("center"),
+                                          zoom=view.get("zoom"),
+                                          scale_data=layer_data,
+                                          track_view=geojson is None)
+            # Draw the boundaries around where the map was moved to
+            if geojson is None and update_map_view("cbsa_map_view", map_state):
+                st.rerun()
+            # Resolve the clicked CBSA from where it was clicked, against the boundaries the map was drawn with
+            cbsa = None
+            if map_state["last_object_clicked"] is not None:
+                cbsa = locate_cbsa(map_state["last_object_clicked"]["lat"],
+                                   map_state["last_object_clicked"]["lng"],
+                                   zoom=view.get("zoom", NATIONAL_ZOOM))
 
         with st.spinner("Loading data table..."):
             # Display the underlying map data
-            display_dataframe(data=data,
+            display_dataframe(data=layer_data,
                               metric_internal_name=metric_internal_name,
                               metric_display_name=metric_display_name,
                               geographic_granularity_internal_name=geographic_granularity_internal_name,
                               geographic_granularity_display_name=geographic_granularity)
 
-        if last_object_clicked_tooltip["last_object_clicked_tooltip"] is not None:
+        if cbsa is not None:
+            cbsa_name = cbsa["cbsa"]
+            # Warm the drill downs of the CBSAs around it, likely to be clicked next
+            prefetcher.record_click(cbsa_name, metric_internal_name, year, base_year)
             # Add a divider
             st.divider()
 
             with st.spinner("Loading drill down map..."):
                 st.markdown(f"### ZCTA drill down into {cbsa_name}")
-                # Query ZCTAs for the selected CBSA
-                zcta_data = get_geographic_mapping(
-                    "ZCTA")["data_function"](cbsa_name=cbsa_name)
-                zcta_geom_boundaries = get_geographic_mapping("ZCTA")[
-                    "geom_function"](cbsa_name=cbsa_name)
-                zcta_geographic_granularity_internal_name = get_geographic_mapping("ZCTA")[
-                    "on_column"]
-
-                # Clean the data
-                zcta_data[metric_internal_name] = pd.to_numeric(
-                    zcta_data[metric_internal_name], errors="coerce")
-                zcta_data = zcta_geom_boundaries.merge(
-                    zcta_data, on=zcta_geographic_granularity_internal_name, how="inner")
-                zcta_data = zcta_data[[zcta_geographic_granularity_internal_name,
-                                       metric_internal_name, "geometry"]]
+                zcta_granularity_info = get_geographic_mapping("ZCTA")
+                zcta_geographic_granularity_internal_name = zcta_granularity_info["on_column"]
+                # Load the TopoJSON of the CBSA and query its ZCTAs together
+                zcta_loaded = load_concurrently(
+                    topology=lambda: zcta_granularity_info["topology_function"](
+                        cbsa_name=cbsa_name),
+                    layer_data=lambda: load_granularity_map(zcta_granularity_info, metric_internal_name, year, base_year,
+                                                            cbsa_name=cbsa_name, with_geometry=False))
+                # Prefer the TopoJSON of the CBSA, which stores shared ZCTA boundaries once
+                zcta_topology = zcta_loaded["topology"]
+                zcta_layer_data = zcta_loaded["layer_data"]
+
+                # Then its pre-serialized GeoJSON
+                zcta_geojson = None
+                if zcta_topology is None:
+                    zcta_geojson = zcta_granularity_info["geojson_function"](
+                        cbsa_name=cbsa_name, version=artifact_version)
+
+                zcta_with_geometry = zcta_topology is None and zcta_geojson is None
+                zcta_view_key = f"zcta_map_view_{cbsa_name}"
+                zcta_view = get_map_view(zcta_view_key) if zcta_with_geometry else {}
+                zcta_data = zcta_layer_data if not zcta_with_geometry else load_granularity_map(
+                    zcta_granularity_info, metric_internal_name, year, base_year,
+                    cbsa_name=cbsa_name,
+                    zoom=zcta_view.get("zoom", DRILL_DOWN_ZOOM),
+                    bounds=zcta_view.get("bounds"))
+
                 # Create the choropleth
-                last_object_clicked_tooltip = create_choropleth(data=zcta_data,
-                                                                target_column=metric_internal_name,
-                                                                height=600,
-                                                                aliases=["ZCTA",
-                                                                         metric_display_name],
-                                                                colormap_caption=metric_display_name,
-                                                                cbsa_internal_points=get_cbsa_center_point(cbsa_name))
+                zcta_map_state = create_choropleth(data=zcta_data,
+                                                   target_column=metric_internal_name,
+                                                   height=600,
+                                                   aliases=["ZCTA",
+                                                            metric_display_name],
+                                                   colormap_caption=metric_display_name,
+                                                   cbsa_internal_points=cbsa["centroid"],
+                                                   topology=zcta_topology,
+                                                   geojson=zcta_geojson,
+                                                   on_column=zcta_geographic_granularity_internal_name,
+                                                   center=zcta_view.get(
+                                                       "center"),
+                                                   zoom=zcta_view.get("zoom"),
+                                                   scale_data=zcta_layer_data,
+                                                   track_view=zcta_with_geometry,
+                                                   fit_bounds=cbsa["bounds"])
+                if zcta_with_geometry and update_map_view(zcta_view_key, zcta_map_state):
+                    st.rerun()
 
                 with st.spinner("Loading data table..."):
                     # Display the underlying map data
-                    display_dataframe(data=zcta_data,
+                    display_dataframe(data=zcta_layer_data,
                                       metric_internal_name=metric_internal_name,
                                       metric_display_name=metric_display_name,
                                       geographic_granularity_internal_name=zcta_geographic_granularity_internal_name,
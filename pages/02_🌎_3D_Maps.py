@@ -1,14 +1,14 @@
 import os
 
-import pandas as pd
 import pydeck as pdk
 import streamlit as st
 from dotenv import load_dotenv
 from streamlit_extras.app_logo import add_logo
 
 from display import display_dataframe
-from mapping.create import create_3d_map
-from mapping.utils import get_geographic_mapping
+from mapping.create import create_3d_map, create_3d_tile_map, get_tile_url
+from mapping.utils import get_geographic_mapping, load_granularity_map
+from queries.data import load_metric_range
 from sidebar import init_sidebar
 from utils import get_metric_internal_name, reduce_top_margin
 
@@ -51,33 +51,44 @@ def app():
         - Taller and redder polygons represent higher values of the selected metric.
         - Shorter and whiter polygons represent smaller values of the selected KPI.
 
-    **Data Source (2021):**
+    **Data Source:**
     
-    The 3D maps are based on the [Selected Housing Characteristics dataset (2021)](https://data.census.gov/table/ACSDP5Y2021.DP04) from the American Community Survey, compiled by the [Census Bureau](https://www.census.gov/).
+    The 3D maps are based on the [Selected Housing Characteristics dataset](https://data.census.gov/table/ACSDP5Y2021.DP04) from the American Community Survey 5-year estimates, compiled by the [Census Bureau](https://www.census.gov/).
     """
     )
 
     # Initalize the sidebar
-    metric_display_name = init_sidebar()
+    metric_display_name, year, base_year = init_sidebar()
     metric_internal_name = get_metric_internal_name(metric_display_name)
+    if base_year is not None:
+        metric_display_name = f"Change in {metric_display_name} since {base_year}"
+
+    # ZCTAs are too many to send at once, so they are only offered when they can be streamed as vector tiles
+    if base_year is None and get_tile_url("zcta", metric_internal_name, year) is not None:
+        geographic_granularity = st.radio("Geography", options=["CBSA", "ZCTA"],
+                                          horizontal=True, key="geographic_granularity_key")
+    else:
+        geographic_granularity = "CBSA"
+
+    if geographic_granularity == "ZCTA":
+        min_value, max_value = load_metric_range(
+            "zcta", metric_internal_name, year)
+        with st.spinner("Loading map..."):
+            create_3d_tile_map(layer="zcta",
+                               target_column=metric_internal_name,
+                               target_display_name=metric_display_name,
+                               year=year,
+                               min_value=min_value,
+                               max_value=max_value)
+        return
 
-    geographic_granularity = "CBSA"
     # Get mapping information
     granularity_info = get_geographic_mapping(geographic_granularity)
     if granularity_info:
-        geom_boundaries = granularity_info["geom_function"]()
-        data = granularity_info["data_function"]()
+        data = load_granularity_map(
+            granularity_info, metric_internal_name, year, base_year)
         geographic_granularity_internal_name = granularity_info["on_column"]
 
-        # Clean the data
-        data[metric_internal_name] = pd.to_numeric(
-            data[metric_internal_name], errors="coerce")
-        data = geom_boundaries.merge(
-            data, on=granularity_info["on_column"], how="inner")
-        data = data[[geographic_granularity_internal_name,
-                     metric_internal_name, "geometry"]]
-        data.dropna(inplace=True)
-
         with st.spinner("Loading map..."):
             # Create the 3D map
             create_3d_map(data=data,
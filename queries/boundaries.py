@@ -1,20 +1,94 @@
+import json
+import os
+
 import geopandas as gpd
+import numpy as np
 import pandas as pd
+import shapely
 import streamlit as st
 
 from utils import init_connection
 
+# Geometry column -> simplification tolerance in degrees, as built by the
+# pipeline's `GEOMETRY_LEVELS_OF_DETAIL`
+GEOMETRY_LEVELS_OF_DETAIL = {
+    "geometry": 0.001,
+    "geometry_medium": 0.005,
+    "geometry_coarse": 0.02,
+}
+
+# The SRID of the boundaries, as built by the pipeline's `BOUNDARY_SRID`
+BOUNDARY_SRID = 4269
+
+# Where the pipeline publishes boundary files, see its `artifacts.py`
+ARTIFACT_DIR = os.getenv("ARTIFACT_DIR",
+                         os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "artifacts"))
+
+# Zoom levels the maps are first drawn at
+NATIONAL_ZOOM = 4
+DRILL_DOWN_ZOOM = 7
+
+# How many CBSAs' drill downs are kept cached, including those prefetched
+MAX_CACHED_DRILL_DOWNS = 64
+
+
+def get_geometry_column(zoom: float) -> str:
+    """Picks the coarsest level of detail whose tolerance is under half a pixel at `zoom`, so simplifying it is invisible
+
+    Args:
+        zoom (float): The web map zoom level
+
+    Returns:
+        str: The geometry column to read
+    """
+    # Degrees of longitude covered by one pixel of a 256px web mercator tile at the equator
+    degrees_per_pixel = 360 / (256 * 2 ** zoom)
+    visible_levels = {column: tolerance for column, tolerance in GEOMETRY_LEVELS_OF_DETAIL.items()
+                      if tolerance <= degrees_per_pixel / 2}
+    if not visible_levels:
+        return min(GEOMETRY_LEVELS_OF_DETAIL, key=GEOMETRY_LEVELS_OF_DETAIL.get)
+    return max(visible_levels, key=visible_levels.get)
+
+
+def get_artifact_version() -> str:
+    """The version of the boundary files `current` points at, or None if the pipeline has
+    not published any. The functions caching them take it as an argument, so a newly
+    published version is read instead of the one they cached.
+    """
+    link = os.path.join(ARTIFACT_DIR, "current")
+    return os.path.basename(os.readlink(link)) if os.path.islink(link) else None
 
-@st.cache_data(show_spinner=False)
-def load_cbsa_geom_data():
+
+def get_artifact_path(name: str, version: str = None) -> str:
+    """The path of a published boundary file, or None if the pipeline has not published it
+
+    The path is in `version`, or else in the version `current` points at now, so files
+    read one after another come from the same version even if another one is published meanwhile.
+    """
+    path = os.path.realpath(os.path.join(ARTIFACT_DIR, version or "current", name))
+    return path if os.path.exists(path) else None
+
+
+def read_boundary_artifact(name: str, columns: list, geometry_column: str, filters: list = None, version: str = None) -> gpd.GeoDataFrame:
+    # Memory mapped, so only the pages of the requested columns and row groups are read
+    geom_boundaries = gpd.read_parquet(get_artifact_path(name, version), columns=columns + [geometry_column],
+                                       filters=filters, memory_map=True)
+    return geom_boundaries.rename_geometry("geometry") if geometry_column != "geometry" else geom_boundaries
+
+
+def read_cbsa_geom(geometry_column: str, version: str = None) -> gpd.GeoDataFrame:
+    if get_artifact_path("cbsa_boundaries.parquet", version) is not None:
+        return read_boundary_artifact("cbsa_boundaries.parquet", columns=["cbsa", "cbsa_code"],
+                                      geometry_column=geometry_column, version=version)
 
     conn = init_connection()
 
     geom_boundaries = gpd.read_postgis(
-        """
+        f"""
     select 
         "NAMELSAD"
-        , geometry
+        , "CBSAFP" as cbsa_code
+        , {geometry_column} as geometry
     from geospatial.cbsa_boundaries_2021_simplified
     """, con=conn, geom_col="geometry")
     geom_boundaries.rename(columns={"NAMELSAD": "cbsa"}, inplace=True)
@@ -22,41 +96,263 @@ def load_cbsa_geom_data():
     return geom_boundaries
 
 
-@st.cache_data(show_spinner=False, ttl=3600*24)
-def load_zcta_geom(cbsa_name: str):
+def read_zcta_geom(geometry_column: str, version: str = None) -> gpd.GeoDataFrame:
+    """Reads the boundaries of every ZCTA, whichever CBSA it is in
+    """
+    if get_artifact_path("zcta_boundaries.parquet", version) is not None:
+        geom_boundaries = read_boundary_artifact("zcta_boundaries.parquet", columns=["zcta"],
+                                                 geometry_column=geometry_column, version=version)
+        # ZCTAs in several CBSAs are published once per CBSA
+        return geom_boundaries.drop_duplicates(subset="zcta")
+
     conn = init_connection()
 
     geom_boundaries = gpd.read_postgis(
-        """
+        f"""
     select 
-        zcta_boundaries_2021_simplified."ZCTA5CE20"
-        , zcta_boundaries_2021_simplified.geometry
+        "ZCTA5CE20"
+        , {geometry_column} as geometry
     from geospatial.zcta_boundaries_2021_simplified
-        left join geospatial.zip_to_cbsa
-            on geospatial.zip_to_cbsa.zip_code = geospatial.zcta_boundaries_2021_simplified."ZCTA5CE20"
-        left join geospatial.cbsa_boundaries_2021_simplified
-            on geospatial.cbsa_boundaries_2021_simplified."CBSAFP" = geospatial.zip_to_cbsa.cbsa_code
+    """, con=conn, geom_col="geometry")
+    geom_boundaries.rename(columns={"ZCTA5CE20": "zcta"}, inplace=True)
+
+    return geom_boundaries
+
+
+def get_bounds_filter(table: str) -> str:
+    """A condition keeping the rows of `table` whose boundary's bounding box
+    intersects the `west`, `south`, `east` and `north` parameters, answered
+    from the table's GiST index
+    """
+    return f"""and geospatial.{table}.geometry && ST_MakeEnvelope(%(west)s, %(south)s, %(east)s, %(north)s,
+            {BOUNDARY_SRID})"""
+
+
+def get_bounds_params(bounds: tuple) -> dict:
+    west, south, east, north = bounds
+    return {"west": west, "south": south, "east": east, "north": north}
+
+
+@st.cache_data(show_spinner=False, ttl=3600*24, max_entries=MAX_CACHED_DRILL_DOWNS)
+def load_cbsa_geom_in_bounds(geometry_column: str, bounds: tuple) -> gpd.GeoDataFrame:
+    """Reads only the CBSA boundaries in `bounds` from the database, for when
+    they have not been published and the whole store would have to be queried
+    """
+    conn = init_connection()
+
+    geom_boundaries = gpd.read_postgis(
+        f"""
+    select 
+        "NAMELSAD"
+        , {geometry_column} as geometry
+    from geospatial.cbsa_boundaries_2021_simplified
+    where 1=1
+        {get_bounds_filter("cbsa_boundaries_2021_simplified")}
+    """, con=conn, geom_col="geometry", params=get_bounds_params(bounds))
+    geom_boundaries.rename(columns={"NAMELSAD": "cbsa"}, inplace=True)
+
+    return geom_boundaries
+
+
+@st.cache_data(show_spinner=False, ttl=3600*24, max_entries=MAX_CACHED_DRILL_DOWNS)
+def load_zcta_geom_of_cbsa(cbsa_name: str, geometry_column: str, bounds: tuple = None) -> gpd.GeoDataFrame:
+    """Reads only the boundaries of the ZCTAs of `cbsa_name`, and in `bounds` if
+    given, from the database, for when they have not been published
+    """
+    conn = init_connection()
+
+    geom_boundaries = gpd.read_postgis(
+        f"""
+    select 
+        zcta_boundaries_2021_simplified."ZCTA5CE20"
+        , zcta_boundaries_2021_simplified.{geometry_column} as geometry
+    from geospatial.zcta_cbsa_membership
+        inner join geospatial.zcta_boundaries_2021_simplified
+            on geospatial.zcta_boundaries_2021_simplified."ZCTA5CE20" = geospatial.zcta_cbsa_membership.zcta
     where 1=1
-        and geospatial.cbsa_boundaries_2021_simplified."NAMELSAD" =  %(cbsa_name)s
+        and geospatial.zcta_cbsa_membership.cbsa = %(cbsa_name)s
+        {get_bounds_filter("zcta_boundaries_2021_simplified") if bounds is not None else ""}
     """,
         con=conn,
         geom_col="geometry",
-        params={"cbsa_name": cbsa_name})
+        params={"cbsa_name": cbsa_name, **(get_bounds_params(bounds) if bounds is not None else {})})
     geom_boundaries.rename(columns={"ZCTA5CE20": "zcta"}, inplace=True)
 
     return geom_boundaries
 
 
-def get_cbsa_center_point(cbsa_name) -> list:
+class GeometryStore:
+    """The boundaries of one geography, held once per process and shared by
+    every session. `st.cache_data` would unpickle a fresh copy of them on every
+    hit, so they are cached as a resource and never modified; maps are built by
+    joining a session's data onto references to the same geometries.
+    """
+
+    def __init__(self, geom_boundaries: gpd.GeoDataFrame, on_column: str):
+        self.on_column = on_column
+        self.crs = geom_boundaries.crs
+        self.index = pd.Index(geom_boundaries[on_column])
+        # Any other columns, e.g. codes, as they are not joined onto the data
+        self.attributes = pd.DataFrame(geom_boundaries.drop(
+            columns=geom_boundaries.geometry.name)).reset_index(drop=True)
+        # An array of shapely geometries, which are immutable themselves
+        self.geometries = np.asarray(geom_boundaries.geometry.array)
+        self.geometries.flags.writeable = False
+        # Indexes the bounding boxes of the geometries, like the GiST index of their table
+        self.tree = shapely.STRtree(self.geometries)
+
+    def join(self, data: pd.DataFrame, bounds: tuple = None) -> gpd.GeoDataFrame:
+        """Adds the boundary of each row of `data` as its geometry, dropping rows without one
+
+        Args:
+            data (pd.DataFrame): The data to map, with an `on_column` column
+            bounds (tuple, optional): Only keep the rows whose boundary's bounding box intersects this
+                `(west, south, east, north)` box
+
+        Returns:
+            gpd.GeoDataFrame: `data` with a `geometry` column, whose geometries are shared with the store
+        """
+        positions = self.index.get_indexer(data[self.on_column])
+        found = positions >= 0
+        if bounds is not None:
+            in_bounds = np.zeros(len(self.geometries), dtype=bool)
+            in_bounds[self.tree.query(shapely.box(*bounds))] = True
+            found &= in_bounds[positions]
+        return gpd.GeoDataFrame(data[found], geometry=self.geometries[positions[found]], crs=self.crs)
+
+    def get_neighbors(self, key: str, k: int = 5) -> list:
+        """The keys of the `k` boundaries nearest to the boundary of `key`, nearest first
+        """
+        position = self.index.get_indexer([key])[0]
+        if position < 0:
+            return []
+        geometry = self.geometries[position]
+
+        # Only look around the boundary, within its own size
+        west, south, east, north = shapely.bounds(geometry)
+        width, height = east - west, north - south
+        candidates = self.tree.query(shapely.box(
+            west - width, south - height, east + width, north + height))
+        candidates = candidates[candidates != position]
+        distances = shapely.distance(geometry, self.geometries[candidates])
+        return self.index[candidates[np.argsort(distances)[:k]]].tolist()
+
+    def locate(self, longitude: float, latitude: float) -> dict:
+        """Finds the boundary containing a point, e.g. where a map was clicked
+
+        Args:
+            longitude (float): The longitude of the point
+            latitude (float): The latitude of the point
+
+        Returns:
+            dict: The boundary's columns, its `bounds` as `(west, south, east, north)` and its
+                `centroid` as `[latitude, longitude]`, or None if no boundary contains the point
+        """
+        matches = self.tree.query(shapely.Point(
+            longitude, latitude), predicate="intersects")
+        if len(matches) == 0:
+            return None
+        position = matches.min()
+        geometry = self.geometries[position]
+        centroid = shapely.centroid(geometry)
+        return {
+            **self.attributes.iloc[position].to_dict(),
+            "bounds": tuple(shapely.bounds(geometry)),
+            "centroid": [centroid.y, centroid.x],
+        }
+
+
+# Both geographies at every level of detail, of the current and the previous artifact version
+@st.cache_resource(show_spinner=False, ttl=3600*24, max_entries=4 * len(GEOMETRY_LEVELS_OF_DETAIL))
+def load_geometry_store(geography: str, geometry_column: str, version: str) -> GeometryStore:
+    """The shared boundaries of every `geography` at one level of detail
+
+    Args:
+        geography (str): `cbsa` or `zcta`
+        geometry_column (str): The level of detail, as picked by `get_geometry_column`
+        version (str): The artifact version to read, from `get_artifact_version`, or None to read the database
+
+    Returns:
+        GeometryStore: The boundaries, which must not be modified
+    """
+    if geography == "cbsa":
+        return GeometryStore(read_cbsa_geom(geometry_column, version), on_column="cbsa")
+    return GeometryStore(read_zcta_geom(geometry_column, version), on_column="zcta")
+
+
+def locate_cbsa(latitude: float, longitude: float, zoom: float = NATIONAL_ZOOM) -> dict:
+    """The CBSA at a point of a map drawn at `zoom`, resolved in memory without querying the database
+
+    Returns:
+        dict: The `cbsa` name, `cbsa_code`, `bounds` and `centroid` of the CBSA, or None if there is none
+    """
+    return load_geometry_store("cbsa", get_geometry_column(zoom),
+                               get_artifact_version()).locate(longitude, latitude)
+
+
+@st.cache_data(show_spinner=False, ttl=3600*24, max_entries=2)
+def load_cbsa_geojson(version: str) -> dict:
+    """Loads the pre-serialized GeoJSON of the CBSAs at the national level of detail
+
+    Args:
+        version (str): The artifact version to read, from `get_artifact_version`
+
+    Returns:
+        dict: A FeatureCollection with a `cbsa` property, or None if it has not been published
+    """
+    if version is None:
+        return None
+    path = get_artifact_path("cbsa_boundaries.geojson", version)
+    if path is None:
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+@st.cache_data(show_spinner=False, ttl=3600*24, max_entries=MAX_CACHED_DRILL_DOWNS)
+def load_zcta_geojson(cbsa_name: str, version: str) -> dict:
+    """Loads the pre-serialized GeoJSON of the ZCTAs of `cbsa_name` at the drill-down level of detail
+
+    Args:
+        cbsa_name (str): The CBSA to drill down into
+        version (str): The artifact version to read, from `get_artifact_version`
+
+    Returns:
+        dict: A FeatureCollection with a `zcta` property, or None if it has not been published
+    """
+    if version is None or get_artifact_path("cbsa_boundaries.parquet", version) is None:
+        return None
+    cbsa_codes = pd.read_parquet(get_artifact_path("cbsa_boundaries.parquet", version), columns=["cbsa_code"],
+                                 filters=[("cbsa", "=", cbsa_name)])
+    if cbsa_codes.empty:
+        return None
+
+    path = get_artifact_path(
+        os.path.join("zcta_boundaries", f"{cbsa_codes['cbsa_code'].iloc[0]}.geojson"), version)
+    if path is None:
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+@st.cache_data(show_spinner=False, ttl=3600*24, max_entries=MAX_CACHED_DRILL_DOWNS)
+def load_zcta_topojson(cbsa_name: str) -> dict:
+    """Loads the ZCTAs of `cbsa_name` as a TopoJSON topology whose object `zcta` holds one geometry per ZCTA
+
+    Returns:
+        dict: The topology, or None if it has not been built for the CBSA
+    """
     conn = init_connection()
-    point = pd.read_sql("""
-    select 
-        "INTPTLAT"::numeric as internal_latitude
-        , "INTPTLON"::numeric as internal_longitude 
-    from geospatial.cbsa_boundaries_2021_simplified
-    where "NAMELSAD" = %(cbsa_name)s
+
+    topology = pd.read_sql(
+        """
+    select topojson
+    from geospatial.zcta_topojson_2021
+    where cbsa = %(cbsa_name)s
     """,
-                        con=conn,
-                        params={"cbsa_name": cbsa_name})
+        con=conn,
+        params={"cbsa_name": cbsa_name})
 
-    return point
+    if topology.empty:
+        return None
+    return json.loads(topology["topojson"].iloc[0])
@@ -1,86 +1,46 @@
 import pandas as pd
 import streamlit as st
 
+from metrics import get_metric_expression
 from utils import init_connection
 
 
-@st.cache_data(show_spinner=False)
-def load_cbsa_acs_data():
+# Each cached year holds a full copy of its data, so only keep a few of them in memory
+MAX_CACHED_YEARS = 4
 
+
+@st.cache_data(show_spinner=False, ttl=3600)
+def load_acs_years() -> list:
+    """Lists the ACS vintages loaded into the database, newest first
+    """
     conn = init_connection()
 
-    data = pd.read_sql(
+    years = pd.read_sql(
         """
-        select 
-            cbsa
-        -- Metric 1
-            , est_gross_rent_occupied_units_paying_rent_median_dollars
-        
-        -- Metric 2
-            , percent_housing_tenure_occupied_housing_units_renter_occupied
-        
-        -- Metric 3
-            , percent_house_heating_fuel_occupied_housing_units_solar_energy::numeric +
-                percent_house_heating_fuel_occupied_housing_units_electricity::numeric +
-                percent_house_heating_fuel_occupied_housing_units_no_fuel_used::numeric +
-                percent_house_heating_fuel_occupied_housing_units_other_fuel::numeric AS percent_renewable_energy
-
-        -- Metric 4
-            , percent_house_heating_fuel_occupied_housing_units_fuel_oil::numeric +
-                percent_house_heating_fuel_occupied_housing_units_coal_or_coke::numeric +
-                percent_house_heating_fuel_occupied_housing_units_wood::numeric +
-                percent_house_heating_fuel_occupied_housing_units_gas_tank::numeric as percent_fossil_fuel
-
-        -- Metric 5
-            , est_value_owner_occupied_units_median_dollars
-        from geospatial.acs_census_2021_cbsa
-        -- where est_gross_rent_occupied_units_paying_rent_median_dollars is not null
+        select distinct year
+        from geospatial.acs_metrics_cbsa
+        order by year desc
         """, con=conn)
 
-    return data
-
+    return years["year"].tolist()
 
-@st.cache_data(show_spinner=False)
-def load_zcta_acs_data(cbsa_name: str):
 
+@st.cache_data(show_spinner=False, max_entries=MAX_CACHED_YEARS * 5)
+def load_metric_range(geography: str, metric: str, year: int = 2021) -> tuple:
+    """The smallest and largest value of `metric` across every `geography`, for scaling maps drawn from vector tiles
+    """
     conn = init_connection()
 
-    data = pd.read_sql(
-        """
-        select 
-            zcta
-        -- Metric 1
-            , est_gross_rent_occupied_units_paying_rent_median_dollars
-        
-        -- Metric 2
-            , percent_housing_tenure_occupied_housing_units_renter_occupied
-    
-        -- Metric 3
-            , percent_house_heating_fuel_occupied_housing_units_solar_energy::numeric +
-                percent_house_heating_fuel_occupied_housing_units_electricity::numeric +
-                percent_house_heating_fuel_occupied_housing_units_no_fuel_used::numeric +
-                percent_house_heating_fuel_occupied_housing_units_other_fuel::numeric AS percent_renewable_energy
-
-        -- Metric 4
-            , percent_house_heating_fuel_occupied_housing_units_fuel_oil::numeric +
-                percent_house_heating_fuel_occupied_housing_units_coal_or_coke::numeric +
-                percent_house_heating_fuel_occupied_housing_units_wood::numeric +
-                percent_house_heating_fuel_occupied_housing_units_gas_tank::numeric as percent_fossil_fuel
-
-            -- Metric 5
-            , est_value_owner_occupied_units_median_dollars
-        from geospatial.acs_census_2021_zcta
-            left join geospatial.zip_to_cbsa
-                on geospatial.zip_to_cbsa.zip_code = geospatial.acs_census_2021_zcta.zcta
-            left join geospatial.cbsa_boundaries_2021_simplified
-                on geospatial.cbsa_boundaries_2021_simplified."CBSAFP" = geospatial.zip_to_cbsa.cbsa_code
-        where 1=1
-            and geospatial.cbsa_boundaries_2021_simplified."NAMELSAD" =  %(cbsa_name)s
+    metric_range = pd.read_sql(
+        f"""
+        select
+            min({get_metric_expression(metric, "metrics")}) as min_value
+            , max({get_metric_expression(metric, "metrics")}) as max_value
+        from geospatial.acs_metrics_{geography} as metrics
+        where year = %(year)s
         """,
         con=conn,
-        params={"cbsa_name": cbsa_name}
+        params={"year": year}
     )
 
-    # conn.close()
-
-    return data
+    return metric_range["min_value"].iloc[0], metric_range["max_value"].iloc[0]
@@ -0,0 +1,147 @@
+import geopandas as gpd
+import pandas as pd
+import streamlit as st
+
+from metrics import get_metric_expression
+from queries.boundaries import (DRILL_DOWN_ZOOM, MAX_CACHED_DRILL_DOWNS,
+                                NATIONAL_ZOOM, get_artifact_path,
+                                get_artifact_version, get_geometry_column, load_cbsa_geom_in_bounds,
+                                load_geometry_store, load_zcta_geom_of_cbsa)
+from queries.data import MAX_CACHED_YEARS
+from utils import init_connection, load_concurrently
+
+# Geography -> the boundary table it is drawn from and how to join the ACS metrics onto it
+GEOGRAPHIES = {
+    "cbsa": {
+        "table": "cbsa_boundaries_2021_simplified",
+        "key_column": '"NAMELSAD"',
+        "metrics_table": "acs_metrics_cbsa",
+    },
+    "zcta": {
+        "table": "zcta_boundaries_2021_simplified",
+        "key_column": '"ZCTA5CE20"',
+        "metrics_table": "acs_metrics_zcta",
+    },
+}
+
+
+def get_map_query(geography: str, metric: str, base_year: int = None, where: str = "") -> str:
+    """Builds the query of one metric of every `geography` that has a boundary
+
+    Args:
+        geography (str): A key of `GEOGRAPHIES`
+        metric (str): The metric to select, from the registry in `metrics.py`
+        base_year (int, optional): If given, select the change in `metric` since this year instead of its value
+        where (str, optional): Extra conditions, each starting with `and`
+
+    Returns:
+        str: A query taking `year` and `base_year` parameters
+    """
+    config = GEOGRAPHIES[geography]
+    value = get_metric_expression(metric, "current_year")
+    base_year_join = ""
+    if base_year is not None:
+        value = f"({value}) - ({get_metric_expression(metric, 'base_year')})"
+        base_year_join = f"""
+            inner join geospatial.{config["metrics_table"]} as base_year
+                on base_year.{geography} = current_year.{geography}
+                and base_year.year = %(base_year)s"""
+
+    return f"""
+        select
+            current_year.{geography}
+            , {value} as {metric}
+        from geospatial.{config["table"]} as boundaries
+            inner join geospatial.{config["metrics_table"]} as current_year
+                on current_year.{geography} = boundaries.{config["key_column"]}
+                and current_year.year = %(year)s{base_year_join}
+        where 1=1
+            and ({value}) is not null
+            {where}
+        """
+
+
+@st.cache_data(show_spinner=False, max_entries=MAX_CACHED_YEARS * 5)
+def load_cbsa_metric_data(metric: str, year: int = 2021, base_year: int = None) -> pd.DataFrame:
+    conn = init_connection()
+    return pd.read_sql(get_map_query("cbsa", metric, base_year), con=conn,
+                       params={"year": year, "base_year": base_year})
+
+
+@st.cache_data(show_spinner=False, max_entries=MAX_CACHED_DRILL_DOWNS)
+def load_zcta_metric_data(cbsa_name: str, metric: str, year: int = 2021, base_year: int = None) -> pd.DataFrame:
+    conn = init_connection()
+    query = get_map_query("zcta", metric, base_year,
+                          where="""and boundaries."ZCTA5CE20" in (
+                select zcta
+                from geospatial.zcta_cbsa_membership
+                where cbsa = %(cbsa_name)s
+            )""")
+    return pd.read_sql(query, con=conn,
+                       params={"cbsa_name": cbsa_name, "year": year, "base_year": base_year})
+
+
+def join_geometry(data: pd.DataFrame, geom_boundaries: gpd.GeoDataFrame, on_column: str) -> gpd.GeoDataFrame:
+    """Like `GeometryStore.join`, for boundaries read for one map only
+    """
+    return gpd.GeoDataFrame(data.merge(geom_boundaries, on=on_column), geometry="geometry", crs=geom_boundaries.crs)
+
+
+def load_cbsa_map_data(metric: str, year: int = 2021, base_year: int = None, zoom: float = NATIONAL_ZOOM, bounds: tuple = None, with_geometry: bool = True) -> pd.DataFrame:
+    """Loads one metric of every CBSA with its boundary, ready to be mapped
+
+    Args:
+        metric (str): The metric to load
+        year (int, optional): The ACS vintage to load
+        base_year (int, optional): If given, load the change in `metric` since this year instead
+        zoom (float, optional): The zoom level the boundaries will be drawn at
+        bounds (tuple, optional): Only load the boundaries intersecting this `(west, south, east, north)` box
+        with_geometry (bool, optional): Whether to add boundaries, False when they come from elsewhere
+
+    Returns:
+        pd.DataFrame: `cbsa`, `metric` and, if `with_geometry`, `geometry`, without missing values
+    """
+    if not with_geometry:
+        return load_cbsa_metric_data(metric, year, base_year)
+    version = get_artifact_version()
+    if bounds is not None and get_artifact_path("cbsa_boundaries.parquet", version) is None:
+        # Without published boundaries, only those in view are queried, through the GiST index of their table
+        loaded = load_concurrently(
+            data=lambda: load_cbsa_metric_data(metric, year, base_year),
+            geom=lambda: load_cbsa_geom_in_bounds(get_geometry_column(zoom), bounds))
+        return join_geometry(loaded["data"], loaded["geom"], on_column="cbsa")
+    # Only the metric is queried, the boundaries are shared by every session and loaded alongside it
+    loaded = load_concurrently(
+        data=lambda: load_cbsa_metric_data(metric, year, base_year),
+        store=lambda: load_geometry_store("cbsa", get_geometry_column(zoom), version))
+    return loaded["store"].join(loaded["data"], bounds)
+
+
+def load_zcta_map_data(cbsa_name: str, metric: str, year: int = 2021, base_year: int = None, zoom: float = DRILL_DOWN_ZOOM, bounds: tuple = None, with_geometry: bool = True) -> pd.DataFrame:
+    """Loads one metric of every ZCTA in `cbsa_name` with its boundary, ready to be mapped
+
+    Args:
+        cbsa_name (str): The CBSA to drill down into
+        metric (str): The metric to load
+        year (int, optional): The ACS vintage to load
+        base_year (int, optional): If given, load the change in `metric` since this year instead
+        zoom (float, optional): The zoom level the boundaries will be drawn at
+        bounds (tuple, optional): Only load the boundaries intersecting this `(west, south, east, north)` box
+        with_geometry (bool, optional): Whether to add boundaries, False when they come from elsewhere
+
+    Returns:
+        pd.DataFrame: `zcta`, `metric` and, if `with_geometry`, `geometry`, without missing values
+    """
+    if not with_geometry:
+        return load_zcta_metric_data(cbsa_name, metric, year, base_year)
+    version = get_artifact_version()
+    if get_artifact_path("zcta_boundaries.parquet", version) is None:
+        # Without published boundaries, only those of the CBSA and in view are queried, rather than every ZCTA in the US
+        loaded = load_concurrently(
+            data=lambda: load_zcta_metric_data(cbsa_name, metric, year, base_year),
+            geom=lambda: load_zcta_geom_of_cbsa(cbsa_name, get_geometry_column(zoom), bounds))
+        return join_geometry(loaded["data"], loaded["geom"], on_column="zcta")
+    loaded = load_concurrently(
+        data=lambda: load_zcta_metric_data(cbsa_name, metric, year, base_year),
+        store=lambda: load_geometry_store("zcta", get_geometry_column(zoom), version))
+    return loaded["store"].join(loaded["data"], bounds)
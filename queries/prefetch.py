@@ -0,0 +1,132 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import streamlit as st
+from loguru import logger
+from streamlit.runtime.scriptrunner import (add_script_run_ctx,
+                                            get_script_run_ctx)
+from streamlit.runtime.scriptrunner.script_run_context import \
+    SCRIPT_RUN_CONTEXT_ATTR_NAME
+
+from metrics import METRICS
+from queries.boundaries import (MAX_CACHED_DRILL_DOWNS, NATIONAL_ZOOM,
+                                get_artifact_version, get_geometry_column,
+                                load_geometry_store, load_zcta_geojson,
+                                load_zcta_topojson)
+from queries.data import load_acs_years
+from queries.maps import load_zcta_map_data
+from utils import init_connection
+
+
+class DrillDownPrefetcher:
+    """Warms the caches of the ZCTA drill downs of the CBSAs users are likely to
+    click next, on a small thread pool shared by every session. What it warms
+    is bounded, and evicted, by the `max_entries` of the cached functions.
+    """
+
+    def __init__(self, max_workers: int = 2, max_pending: int = 16, max_recent: int = 16, neighbors: int = 5):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix="drill-down-prefetch")
+        self.max_pending = max_pending
+        self.max_recent = max_recent
+        self.neighbors = neighbors
+        self.lock = threading.Lock()
+        self.pending = set()
+        # Drill downs warmed recently, so they are not queued again while they are likely still cached
+        self.warmed = OrderedDict()
+        # The CBSAs clicked recently, most recent last
+        self.recent = OrderedDict()
+
+    def submit(self, cbsa_names: list, metric: str, year: int, base_year: int = None):
+        """Queues the drill downs of `cbsa_names`, in order, unless they are queued or warm already
+        """
+        # Cached results are only stored from a thread running a script
+        ctx = get_script_run_ctx()
+        if ctx is None:
+            return
+        for cbsa_name in cbsa_names:
+            key = (cbsa_name, metric, year, base_year)
+            with self.lock:
+                if key in self.pending or key in self.warmed or len(self.pending) >= self.max_pending:
+                    continue
+                self.pending.add(key)
+            self.executor.submit(self.warm, key, ctx)
+
+    def warm(self, key: tuple, ctx):
+        cbsa_name, metric, year, base_year = key
+        thread = threading.current_thread()
+        previous_ctx = getattr(thread, SCRIPT_RUN_CONTEXT_ATTR_NAME, None)
+        add_script_run_ctx(thread, ctx)
+        try:
+            # Load what the drill down would, in the same order
+            with_geometry = load_zcta_topojson(cbsa_name=cbsa_name) is None \
+                and load_zcta_geojson(cbsa_name=cbsa_name, version=get_artifact_version()) is None
+            load_zcta_map_data(cbsa_name, metric, year, base_year, with_geometry=with_geometry)
+        except Exception as e:
+            logger.warning(f"Could not prefetch the drill down of {cbsa_name}: {e}")
+        finally:
+            # Passing None would attach the current context again, so the pooled
+            # thread would hold on to the session until its next task
+            setattr(thread, SCRIPT_RUN_CONTEXT_ATTR_NAME, previous_ctx)
+            with self.lock:
+                self.pending.discard(key)
+                self.warmed[key] = True
+                while len(self.warmed) > MAX_CACHED_DRILL_DOWNS:
+                    self.warmed.popitem(last=False)
+
+    def record_click(self, cbsa_name: str, metric: str, year: int, base_year: int = None):
+        """Remembers a clicked CBSA and prefetches the drill downs of its neighbors
+        """
+        with self.lock:
+            self.recent[cbsa_name] = True
+            self.recent.move_to_end(cbsa_name)
+            while len(self.recent) > self.max_recent:
+                self.recent.popitem(last=False)
+
+        neighbors = load_geometry_store("cbsa", get_geometry_column(NATIONAL_ZOOM),
+                                        get_artifact_version()).get_neighbors(cbsa_name, k=self.neighbors)
+        self.submit(neighbors, metric, year, base_year)
+
+    def follow(self, metric: str, year: int, base_year: int = None):
+        """Prefetches the drill downs of the recently clicked CBSAs for the metric and year being viewed
+        """
+        with self.lock:
+            recent = list(reversed(self.recent))
+        self.submit(recent, metric, year, base_year)
+
+
+def load_largest_cbsas(limit: int) -> list:
+    """The CBSAs with the most ZCTAs, whose drill downs are the slowest to load
+    """
+    conn = init_connection()
+
+    cbsas = pd.read_sql(
+        """
+        select
+            cbsa
+            , count(*) as zctas
+        from geospatial.zcta_cbsa_membership
+        group by cbsa
+        order by zctas desc
+        limit %(limit)s
+        """,
+        con=conn,
+        params={"limit": limit})
+
+    return cbsas["cbsa"].tolist()
+
+
+@st.cache_resource(show_spinner=False)
+def get_drill_down_prefetcher(largest_cbsas: int = 10) -> DrillDownPrefetcher:
+    """The prefetcher shared by every session. When the app starts it prefetches
+    the drill downs of the largest CBSAs, for the metric and year shown first.
+    """
+    prefetcher = DrillDownPrefetcher()
+    try:
+        prefetcher.submit(load_largest_cbsas(largest_cbsas),
+                          metric=next(iter(METRICS)), year=load_acs_years()[0])
+    except Exception as e:
+        logger.warning(f"Could not prefetch the largest CBSAs: {e}")
+    return prefetcher
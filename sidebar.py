@@ -1,6 +1,9 @@
 import pandas as pd
 import streamlit as st
 
+from metrics import get_metric_display_names
+from queries.data import load_acs_years
+
 
 def init_sidebar():
     # Write some instructions / help for the user inside of the sidebar
@@ -17,20 +20,33 @@ def init_sidebar():
     if "metric_display_name" not in st.session_state:
         st.session_state["metric_display_name"] = (
             query_params.get("metric_display_name", [
-                "Median Rent Price ($)"])[0]
+                get_metric_display_names()[0]])[0]
         )
     metric_display_name = st.sidebar.selectbox("Select a Metric",
-                                               options=[
-                                                   "Median Rent Price ($)",
-                                                   "Renter Occupied Housing (%)",
-                                                   "Electric, Renewable, or No Heating Source (%)",
-                                                   "Direct Fossil Fuel Heating Source (%)",
-                                                   "Median Home Value ($)"
-                                               ],
+                                               options=get_metric_display_names(),
                                                index=0,
                                                help="Select a metric to view on the map",
                                                key="metric_display_name_key")
 
+    # Only the selected years are queried and cached, not every loaded vintage
+    years = load_acs_years()
+    year = st.sidebar.selectbox("Select a Year",
+                                options=years,
+                                index=0,
+                                help="Select the ACS 5-year estimates to view, by their final year",
+                                key="year_key")
+
+    base_year = None
+    earlier_years = [y for y in years if y < year]
+    if earlier_years and st.sidebar.toggle("Show change over time",
+                                           value=False,
+                                           help="Map the change in the metric since an earlier year instead of its value",
+                                           key="show_change_key"):
+        base_year = st.sidebar.selectbox("Compare with",
+                                         options=earlier_years,
+                                         index=0,
+                                         key="base_year_key")
+
     st.sidebar.divider()
 
     st.sidebar.markdown(
@@ -47,4 +63,4 @@ def init_sidebar():
     st.sidebar.markdown(
         """You will find the drill down map below the CBSA map if you keep scrolling down 👇""")
 
-    return metric_display_name
+    return metric_display_name, year, base_year
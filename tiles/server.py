@@ -0,0 +1,281 @@
+import gzip
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from dotenv import load_dotenv
+from loguru import logger
+from psycopg2.pool import ThreadedConnectionPool
+
+# Layer -> the boundary table it is drawn from and how to join the ACS metrics onto it
+LAYERS = {
+    "cbsa": {
+        "table": "cbsa_boundaries_2021_simplified",
+        "key_column": '"NAMELSAD"',
+        "metrics_table": "acs_metrics_cbsa",
+        "metrics_key_column": "cbsa",
+    },
+    "zcta": {
+        "table": "zcta_boundaries_2021_simplified",
+        "key_column": '"ZCTA5CE20"',
+        "metrics_table": "acs_metrics_zcta",
+        "metrics_key_column": "zcta",
+    },
+}
+
+# The metrics shared with the app and the pipeline, defined once in the repository's `metrics.json`
+METRICS_FILE = os.getenv("METRICS_FILE",
+                         os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "metrics.json"))
+
+
+def load_metrics() -> list:
+    """The columns of the metrics tables a tile can carry"""
+    with open(METRICS_FILE) as f:
+        return list(json.load(f))
+
+
+METRICS = load_metrics()
+
+# Geometry column -> simplification tolerance in degrees, as built by the
+# pipeline's `GEOMETRY_LEVELS_OF_DETAIL`
+GEOMETRY_LEVELS_OF_DETAIL = {
+    "geometry": 0.001,
+    "geometry_medium": 0.005,
+    "geometry_coarse": 0.02,
+}
+
+# The SRID of the boundaries, as built by the pipeline's `BOUNDARY_SRID`
+BOUNDARY_SRID = 4269
+
+TILE_PATH = re.compile(r"^/(?P<layer>\w+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.mvt$")
+
+TILE_CACHE_DIR = os.getenv("TILE_CACHE_DIR",
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"))
+
+# Tiles are cached until the pipeline next finishes a stage
+DATA_VERSION_TTL = 60
+
+
+def get_geometry_column(zoom: int) -> str:
+    """Picks the coarsest level of detail whose tolerance is under half a pixel at `zoom`
+    """
+    degrees_per_pixel = 360 / (256 * 2 ** zoom)
+    visible_levels = {column: tolerance for column, tolerance in GEOMETRY_LEVELS_OF_DETAIL.items()
+                      if tolerance <= degrees_per_pixel / 2}
+    if not visible_levels:
+        return min(GEOMETRY_LEVELS_OF_DETAIL, key=GEOMETRY_LEVELS_OF_DETAIL.get)
+    return max(visible_levels, key=visible_levels.get)
+
+
+def get_tile_query(layer: str, metric: str, zoom: int) -> str:
+    """Builds the query rendering one tile of `layer`. Polygons are clipped to
+    the tile in web mercator and encoded with ST_AsMVT, with the geography's
+    name and `metric` as attributes.
+    """
+    config = LAYERS[layer]
+    return f"""
+    with bounds as (
+        select
+            ST_TileEnvelope(%(z)s, %(x)s, %(y)s) as geom
+            , ST_Transform(ST_TileEnvelope(%(z)s, %(x)s, %(y)s, margin => 64.0 / 4096),
+                {BOUNDARY_SRID}) as source_geom
+    ),
+    features as (
+        select
+            ST_AsMVTGeom(ST_Transform(boundaries.{get_geometry_column(zoom)}, 3857), bounds.geom, 4096, 64, true) as geom
+            , boundaries.{config["key_column"]} as {layer}
+            , metrics.{metric}
+        from geospatial.{config["table"]} as boundaries
+            inner join bounds
+                on boundaries.geometry && bounds.source_geom
+            left join geospatial.{config["metrics_table"]} as metrics
+                on metrics.{config["metrics_key_column"]} = boundaries.{config["key_column"]}
+                and metrics.year = %(year)s
+    )
+    select ST_AsMVT(features, '{layer}', 4096, 'geom')
+    from features
+    where geom is not null
+    """
+
+
+class TileCache:
+    """An in-memory LRU of gzipped tiles in front of a directory of them. The
+    directory survives restarts and is shared by every server process.
+    """
+
+    def __init__(self, directory: str, max_tiles: int = 10000):
+        self.directory = directory
+        self.max_tiles = max_tiles
+        self.tiles = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_path(self, key: tuple) -> str:
+        return os.path.join(self.directory, *map(str, key[:-1]), f"{key[-1]}.mvt.gz")
+
+    def get(self, key: tuple) -> bytes:
+        with self.lock:
+            if key in self.tiles:
+                self.tiles.move_to_end(key)
+                return self.tiles[key]
+
+        path = self.get_path(key)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            tile = f.read()
+        self.put(key, tile, persist=False)
+        return tile
+
+    def prune(self, version: str):
+        """Drops the tiles of the data versions older than `version`. Newer ones
+        are kept, as other processes may not have seen `version` yet.
+        """
+        with self.lock:
+            for key in [key for key in self.tiles if int(key[0]) < int(version)]:
+                del self.tiles[key]
+
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.isdigit() and int(name) < int(version):
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def put(self, key: tuple, tile: bytes, persist: bool = True):
+        with self.lock:
+            self.tiles[key] = tile
+            self.tiles.move_to_end(key)
+            while len(self.tiles) > self.max_tiles:
+                self.tiles.popitem(last=False)
+
+        if persist:
+            path = self.get_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename so concurrent requests never read a partial tile
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+                f.write(tile)
+            os.replace(f.name, path)
+
+
+class TileServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, pool: ThreadedConnectionPool, cache: TileCache):
+        super().__init__(address, TileRequestHandler)
+        self.pool = pool
+        # The pool raises instead of waiting when it is exhausted, so wait here
+        self.connections = threading.BoundedSemaphore(pool.maxconn)
+        self.cache = cache
+        self.data_version = None
+        self.data_version_checked_at = 0
+        self.data_version_lock = threading.Lock()
+
+    def query(self, sql: str, params: dict = None):
+        with self.connections:
+            conn = self.pool.getconn()
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute(sql, params)
+                    row = cursor.fetchone()
+                conn.rollback()
+                return row[0] if row is not None else None
+            finally:
+                self.pool.putconn(conn)
+
+    def get_data_version(self) -> str:
+        """How many stages the pipeline has completed, which is part of every
+        cache key so tiles rendered from replaced tables are never served
+        """
+        with self.data_version_lock:
+            if time.monotonic() - self.data_version_checked_at > DATA_VERSION_TTL:
+                version = str(self.query(
+                    "select case when is_called then last_value else 0 end from geospatial.pipeline_data_version"))
+                if version != self.data_version:
+                    self.cache.prune(version)
+                self.data_version = version
+                self.data_version_checked_at = time.monotonic()
+            return self.data_version
+
+    def get_tile(self, layer: str, metric: str, year: int, z: int, x: int, y: int) -> bytes:
+        key = (self.get_data_version(), layer, metric, year, z, x, y)
+        tile = self.cache.get(key)
+        if tile is None:
+            mvt = self.query(get_tile_query(layer, metric, z),
+                             {"z": z, "x": x, "y": y, "year": year})
+            tile = gzip.compress(bytes(mvt or b""))
+            self.cache.put(key, tile)
+        return tile
+
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+    """Serves `/{layer}/{z}/{x}/{y}.mvt?metric=<metric>&year=<year>`"""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        match = TILE_PATH.match(url.path)
+        query = parse_qs(url.query)
+        metric = query.get("metric", [METRICS[0]])[0]
+        year = query.get("year", ["2021"])[0]
+
+        if match is None or match["layer"] not in LAYERS:
+            return self.send_error(404, "Unknown tile")
+        if metric not in METRICS or not year.isdigit():
+            return self.send_error(400, "Unknown metric or year")
+
+        z, x, y = int(match["z"]), int(match["x"]), int(match["y"])
+        if z > 22 or x >= 2 ** z or y >= 2 ** z:
+            return self.send_error(404, "Tile out of range")
+
+        try:
+            tile = self.server.get_tile(
+                match["layer"], metric, int(year), z, x, y)
+        except Exception as e:
+            logger.error(f"Error rendering tile {self.path}: {e}")
+            return self.send_error(500, "Could not render tile")
+
+        # Tiles are stored gzipped, only clients that can't take that get them inflated
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = tile
+        else:
+            body = gzip.decompress(tile)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.mapbox-vector-tile")
+        if body is tile:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Cache-Control", "public, max-age=3600")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+if __name__ == "__main__":
+    # Load Environment Variables
+    load_dotenv()
+
+    pool = ThreadedConnectionPool(
+        minconn=1,
+        maxconn=int(os.getenv("TILE_SERVER_CONNECTIONS", 8)),
+        user=os.getenv("POSTGRES_USER"),
+        password=os.getenv("POSTGRES_PASSWORD"),
+        host=os.getenv("POSTGRES_HOST"),
+        port=os.getenv("POSTGRES_PORT"),
+        dbname=os.getenv("POSTGRES_DB"),
+    )
+    cache = TileCache(TILE_CACHE_DIR,
+                      max_tiles=int(os.getenv("TILE_CACHE_SIZE", 10000)))
+
+    port = int(os.getenv("TILE_SERVER_PORT", 8080))
+    server = TileServer(("0.0.0.0", port), pool, cache)
+    logger.success(f"Serving vector tiles on port {port}")
+    server.serve_forever()
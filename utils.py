@@ -1,9 +1,18 @@
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import streamlit as st
 from pandas import isnull
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.engine.base import Engine
+from sqlalchemy.pool import NullPool
+from streamlit.runtime.scriptrunner import (add_script_run_ctx,
+                                            get_script_run_ctx)
+from streamlit.runtime.scriptrunner.script_run_context import \
+    SCRIPT_RUN_CONTEXT_ATTR_NAME
+
+from metrics import METRICS
 
 
 def reduce_top_margin():
@@ -11,9 +20,20 @@ def reduce_top_margin():
         " <style> div[class^='block-container'] { padding-top: 2rem; } </style> ", unsafe_allow_html=True)
 
 
-@st.cache_resource
+@st.cache_resource(show_spinner=False)
 def init_connection() -> Engine:
-    """Initalizes a connection to the database
+    """Initalizes the engine every session shares to query the database
+
+    Its pool holds at most `POSTGRES_POOL_SIZE` (default `5`) connections, plus
+    `POSTGRES_MAX_OVERFLOW` (default `5`) opened under load, so many sessions
+    can't exhaust the connections of Postgres. A query waiting more than
+    `POSTGRES_POOL_TIMEOUT` seconds (default `30`) for a connection, or running
+    more than `POSTGRES_STATEMENT_TIMEOUT` milliseconds (default `30000`, `0` to
+    disable), fails instead of hanging the session.
+
+    With `PGBOUNCER=true`, the connections are pooled by PgBouncer instead, and
+    the statement timeout is set per transaction, which its transaction pooling
+    mode allows.
 
     Returns:
         sqlalchemy.engine.base.Engine: A connection to the database
@@ -23,13 +43,67 @@ def init_connection() -> Engine:
     db_host = os.environ['POSTGRES_HOST']
     db_port = os.environ['POSTGRES_PORT']
     db_name = os.environ['POSTGRES_DB']
+    statement_timeout = int(os.getenv("POSTGRES_STATEMENT_TIMEOUT", 30000))
 
     conn_string = f"postgresql://{db_user}:{db_pass}@{db_host}:{db_port}/{db_name}"
-    engine = create_engine(url=conn_string)
+    if os.getenv("PGBOUNCER", "false").lower() == "true":
+        # PgBouncer rejects startup options and already keeps its connections open
+        engine = create_engine(url=conn_string, poolclass=NullPool)
+
+        @event.listens_for(engine, "begin")
+        def set_statement_timeout(conn):
+            # Through the driver, as executing on `conn` would begin another transaction
+            with conn.connection.dbapi_connection.cursor() as cursor:
+                cursor.execute("set local statement_timeout = %s",
+                               (statement_timeout,))
+    else:
+        engine = create_engine(url=conn_string,
+                               pool_size=int(
+                                   os.getenv("POSTGRES_POOL_SIZE", 5)),
+                               max_overflow=int(
+                                   os.getenv("POSTGRES_MAX_OVERFLOW", 5)),
+                               pool_timeout=int(
+                                   os.getenv("POSTGRES_POOL_TIMEOUT", 30)),
+                               # Replace connections the server closed while idle
+                               pool_pre_ping=True,
+                               pool_recycle=3600,
+                               connect_args={"options": f"-c statement_timeout={statement_timeout}"})
 
     return engine
 
 
+def load_concurrently(**loaders) -> dict:
+    """Calls independent loaders, e.g. queries, at the same time and waits for all
+    of them, so loading takes as long as the slowest of them rather than their sum
+
+    The loaders run with the script run context of the caller, so `st.cache_data`
+    and `st.cache_resource` cache their results as if they were called from the page.
+
+    Args:
+        **loaders: Functions taking no arguments, by the name of their result
+
+    Returns:
+        dict: The result of each loader, by its name
+    """
+    ctx = get_script_run_ctx()
+
+    def run(loader):
+        thread = threading.current_thread()
+        previous_ctx = getattr(thread, SCRIPT_RUN_CONTEXT_ATTR_NAME, None)
+        add_script_run_ctx(thread, ctx)
+        try:
+            return loader()
+        finally:
+            # Passing None would attach the current context again
+            setattr(thread, SCRIPT_RUN_CONTEXT_ATTR_NAME, previous_ctx)
+
+    with ThreadPoolExecutor(max_workers=len(loaders), thread_name_prefix="load") as executor:
+        futures = {name: executor.submit(run, loader)
+                   for name, loader in loaders.items()}
+        # Raises the error of a loader, if any
+        return {name: future.result() for name, future in futures.items()}
+
+
 def title_case_columns(columns: list) -> list:
     """Converts a list of column names to title case
 
@@ -44,11 +118,6 @@ def title_case_columns(columns: list) -> list:
 
 
 def get_metric_internal_name(display_name):
-    mapping = {
-        "Median Rent Price ($)": "est_gross_rent_occupied_units_paying_rent_median_dollars",
-        "Renter Occupied Housing (%)": "percent_housing_tenure_occupied_housing_units_renter_occupied",
-        "Electric, Renewable, or No Heating Source (%)": "percent_renewable_energy",
-        "Direct Fossil Fuel Heating Source (%)": "percent_fossil_fuel",
-        "Median Home Value ($)": "est_value_owner_occupied_units_median_dollars",
-    }
+    mapping = {config["display_name"]: metric for metric,
+               config in METRICS.items()}
     return mapping.get(display_name, display_name)